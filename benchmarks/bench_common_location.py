@@ -0,0 +1,67 @@
+# coding: utf-8
+
+# ------------------------------------------------------------------------
+# Module Name :- Common Location Benchmark
+# Module description : - Times get_common_location against the previous substring based implementation
+#                        on synthetic HDFS table locations
+# Parameters required :- [--locations <count>] [--legacy-sample <count>]
+# ----------------------
+
+import os
+import sys
+import time
+import random
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n','--locations', help='Number of synthetic table locations', type=int, default=100000)
+parser.add_argument('-l','--legacy-sample', help='Number of locations timed with the previous implementation', type=int, default=200)
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pandas as pd
+import hdfs_stats
+
+# The previous implementation: tries every substring of the first location
+# against all the other locations
+def legacy_common_location(dataframe):
+    arr = dataframe['Location'].unique().tolist()
+    n = len(arr)
+    s = arr[0]
+    l = len(s)
+    res = ""
+    for i in range( l) :
+        for j in range( i + 1, l + 1) :
+            stem = s[i:j]
+            k = 1
+            for k in range(1, n):
+                if stem not in arr[k]:
+                    break
+            if (k + 1 == n and len(res) < len(stem)):
+                res = stem
+    return res
+
+def synthetic_locations(count):
+    rnd = random.Random(7)
+    return pd.DataFrame({'Location' : ["hdfs://nameservice1/data/warehouse/commercial/franchise_{0}/db_{1}.db/table_{2}_{3}".format(
+        rnd.randint(0, 3), rnd.randint(0, 9), index, rnd.randint(0, 10 ** 6)) for index in range(count)]})
+
+def timed(function, dataframe):
+    start = time.perf_counter()
+    result = function(dataframe)
+    return time.perf_counter() - start, result
+
+if __name__ == '__main__':
+    locations = synthetic_locations(args.locations)
+    sample = locations.head(args.legacy_sample)
+
+    legacy_secs, legacy_res = timed(legacy_common_location, sample)
+    sample_secs, sample_res = timed(hdfs_stats.get_common_location, sample)
+    full_secs, full_res = timed(hdfs_stats.get_common_location, locations)
+
+    print("Sample of {0} locations".format(len(sample)))
+    print("  legacy : {0:.4f}s -> {1}".format(legacy_secs, legacy_res))
+    print("  current: {0:.4f}s -> {1}".format(sample_secs, sample_res))
+    print("  speedup: {0:.0f}x".format(legacy_secs / max(sample_secs, 1e-9)))
+    print("All {0} locations".format(len(locations)))
+    print("  current: {0:.4f}s -> {1}".format(full_secs, full_res))
@@ -0,0 +1,159 @@
+# coding: utf-8
+
+# ------------------------------------------------------------------------
+# Module Name :- HDFS Stats Pipeline Benchmark
+# Module description : - Runs every stage of hdfs_stats (collection, DataFrame build, segregation,
+#                        report rendering, mail delivery) against a synthetic metastore, a fake
+#                        SparkSession and a local SMTP sink. Reports time, throughput and peak memory
+#                        per stage and compares them with stored baselines
+# Parameters required :- [--scale 1000 10000 ...] [--latency-ms <ms>] [--update-baseline]
+# ----------------------
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import importlib
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s','--scale', help='Numbers of tables to benchmark, e.g. 1000 10000 100000 1000000', type=int, nargs='+', default=[1000, 10000])
+parser.add_argument('-d','--databases', help='Number of databases the tables are spread over', type=int, default=20)
+parser.add_argument('-l','--latency-ms', help='Latency injected in every Spark SQL call', type=float, default=0.0)
+parser.add_argument('-w','--workers', help='Collection threads', type=int, default=8)
+parser.add_argument('--chart-workers', help='Chart rendering processes (child memory is not traced)', type=int, default=1)
+parser.add_argument('--no-memory', help='Skip tracemalloc, which slows the stages down', action='store_true')
+parser.add_argument('-b','--baseline', help='Baseline file', default=os.path.join(BENCH_DIR, 'baseline.json'))
+parser.add_argument('-t','--tolerance', help='Allowed slowdown or memory growth over the baseline, as a fraction', type=float, default=0.25)
+parser.add_argument('--update-baseline', help='Store this run as the baseline', action='store_true')
+parser.add_argument('-o','--output', help='Write the results of this run to a JSON file', default=None)
+args = parser.parse_args()
+
+sys.path[:0] = [os.path.join(BENCH_DIR, '..'), BENCH_DIR]
+import hdfs_stats
+from fake_spark import FakeMetastore, FakeSparkSession
+from smtp_sink import SmtpSink
+
+# hdfs_stats imports pandas and matplotlib on first use, so that import is
+# done here rather than inside the first timed stage
+importlib.import_module('pandas')
+importlib.import_module('matplotlib.backends.backend_agg')
+
+# Returns the JSON config of hdfs_stats for the synthetic databases
+def get_db_json(db_names, smtp_address):
+    db_json = {
+        "admin" : {"email" : "admin@example.com", "all_stats_to_email" : "admin@example.com",
+                   "server_host" : smtp_address[0], "server_port" : smtp_address[1], "starttls" : False},
+        "mail_format" : {"subject" : "HDFS Stats benchmark", "body" : "<html><body>Benchmark</body></html>"}
+    }
+    for db_name in db_names:
+        db_json[db_name] = {"name" : db_name.upper(), "email" : db_name + "@example.com"}
+    return db_json
+
+# Runs <function> and returns (<result>, <seconds>, <peak MB>)
+def run_stage(function):
+    if not args.no_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    secs = time.perf_counter() - start
+    peak_mb = None
+    if not args.no_memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / float(1 << 20)
+        tracemalloc.stop()
+    return result, secs, peak_mb
+
+def run_scale(num_tables, smtp_address):
+    metastore = FakeMetastore(num_tables, args.databases)
+    spark = FakeSparkSession(metastore, args.latency_ms / 1000.0)
+    db_names = metastore.db_names()
+    db_json = get_db_json(db_names, smtp_address)
+    outbox_dir = tempfile.mkdtemp(prefix="hdfs_stats_bench_")
+    results = {}
+
+    def collect():
+        stats, out_dict = hdfs_stats.collect_all_stats(db_names, spark, args.workers), {}
+        for db_name in db_names:
+            hdfs_stats.collect_db_stat(db_name, stats, out_dict)
+        return out_dict
+
+    def send():
+        hdfs_stats.generate_mail(db_json, db_names, report_model, admin=False, outbox_dir=outbox_dir)
+        hdfs_stats.generate_mail(db_json, db_names, report_model, admin=True, outbox_dir=outbox_dir)
+        return hdfs_stats.deliver_outbox(outbox_dir, db_json["admin"])
+
+    try:
+        out_dict, results["collect"], results["collect_mb"] = run_stage(collect)
+        df_all_stats, results["build_dataframe"], results["build_dataframe_mb"] = run_stage(
+            lambda: hdfs_stats.build_stats_frame(list(out_dict.values())))
+        segs, results["segregate"], results["segregate_mb"] = run_stage(
+            lambda: hdfs_stats.segregate_df_on_db(db_names, df_all_stats))
+        report_model, results["render"], results["render_mb"] = run_stage(
+            lambda: hdfs_stats.build_report_model(db_json, db_names, df_all_stats, segs, None, args.chart_workers))
+        failed, results["mail"], results["mail_mb"] = run_stage(send)
+        if failed:
+            raise Exception("Mails not delivered to the sink: " + str(failed))
+    finally:
+        shutil.rmtree(outbox_dir, ignore_errors=True)
+    results["tables"] = len(out_dict)
+    results["collect_tables_per_sec"] = len(out_dict) / results["collect"]
+    results["spark_calls"] = spark.calls
+    return results
+
+def get_baseline_key(num_tables):
+    return "tables={0},databases={1},latency_ms={2}".format(num_tables, args.databases, args.latency_ms)
+
+# Returns the <list> of regressions of <results> against <baseline>
+def find_regressions(key, results, baseline):
+    regressions = []
+    for metric, value in sorted(baseline.items()):
+        if metric in ("tables", "spark_calls", "collect_tables_per_sec") or value is None or results.get(metric) is None:
+            continue
+        if results[metric] > value * (1 + args.tolerance):
+            regressions.append("{0} {1}: {2:.3f} over baseline {3:.3f}".format(key, metric, results[metric], value))
+    return regressions
+
+if __name__ == '__main__':
+    with open(os.path.join(BENCH_DIR, '..', 'df_tables.css')) as css_file:
+        hdfs_stats.style = css_file.read()
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+
+    sink = SmtpSink()
+    smtp_address = sink.start()
+    all_results, regressions = {}, []
+    try:
+        for num_tables in args.scale:
+            key = get_baseline_key(num_tables)
+            print("Benchmarking " + key)
+            results = run_scale(num_tables, smtp_address)
+            all_results[key] = results
+            for stage in ["collect", "build_dataframe", "segregate", "render", "mail"]:
+                peak = results[stage + "_mb"]
+                print("  {0:<16} {1:>9.3f}s  peak {2}".format(stage, results[stage], "-" if peak is None else "{0:.1f} MB".format(peak)))
+            print("  collected {0} tables at {1:.0f} tables/s with {2} Spark calls".format(
+                results["tables"], results["collect_tables_per_sec"], results["spark_calls"]))
+            if key in baselines:
+                regressions.extend(find_regressions(key, results, baselines[key]))
+    finally:
+        sink.stop()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(all_results, output_file, indent=2)
+    if args.update_baseline:
+        baselines.update(all_results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        print("Baseline updated: " + args.baseline)
+    if regressions:
+        print("Regressions over {0:.0%}:".format(args.tolerance))
+        print("\n".join(regressions))
+        sys.exit(1)
@@ -0,0 +1,85 @@
+# coding: utf-8
+
+# ------------------------------------------------------------------------
+# Module Name :- Fake SparkSession
+# Module description : - Answers the Spark SQL statements issued by hdfs_stats (show tables,
+#                        describe formatted, analyze table) from a synthetic metastore, with an
+#                        injectable per call latency
+# ----------------------
+
+import re
+import time
+
+TEXT_FORMAT = "org.apache.hadoop.mapred.TextInputFormat"
+INPUT_FORMATS = [TEXT_FORMAT,
+                 "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                 "org.apache.hadoop.hive.ql.io.orc.OrcInputFormat"]
+
+SHOW_TABLES = re.compile(r"show tables in (\w+)")
+DESCRIBE = re.compile(r"describe formatted (\w+)\.(\w+)")
+ANALYZE = re.compile(r"analyze table (\w+)\.(\w+)")
+
+# Stands in for pyspark.sql.Row: fields are read with row.__getitem__("col_name")
+class FakeRow(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+class FakeDataFrame(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def collect(self):
+        return self.rows
+
+# Synthetic metastore of <num_databases> databases named db_<n>, holding
+# <num_tables> tables in total. Tables are derived from their number, so
+# nothing is stored per table; every 50th table is a view and every 20th
+# table is empty
+class FakeMetastore(object):
+    def __init__(self, num_tables, num_databases):
+        self.num_tables = num_tables
+        self.num_databases = num_databases
+
+    def db_names(self):
+        return ["db_{0}".format(index) for index in range(self.num_databases)]
+
+    def tbl_names(self, db_name):
+        db_index = int(db_name.split('_')[1])
+        return ["tbl_{0}".format(index) for index in range(db_index, self.num_tables, self.num_databases)]
+
+    def describe(self, db_name, tbl_name):
+        index = int(tbl_name.split('_')[1])
+        size = 0 if index % 20 == 0 else (index * 7919) % (1 << 40)
+        return [
+            FakeRow(col_name="Owner", data_type="owner_{0}".format(index % 97)),
+            FakeRow(col_name="Type", data_type="VIEW" if index % 50 == 49 else "MANAGED"),
+            FakeRow(col_name="Location", data_type="hdfs://nameservice1/warehouse/{0}.db/{1}".format(db_name, tbl_name)),
+            FakeRow(col_name="Table Properties", data_type="[totalSize={0}, transient_lastDdlTime={1}]".format(size, 1500000000 + index)),
+            FakeRow(col_name="InputFormat", data_type=INPUT_FORMATS[index % len(INPUT_FORMATS)]),
+            FakeRow(col_name="Statistics", data_type="{0} bytes".format(size))]
+
+# Implements the part of SparkSession used by the describe backend of
+# hdfs_stats. Every sql() call sleeps <latency> seconds first
+class FakeSparkSession(object):
+    version = "fake"
+
+    def __init__(self, metastore, latency=0.0):
+        self.metastore = metastore
+        self.latency = latency
+        self.calls = 0
+
+    def sql(self, statement):
+        self.calls = self.calls + 1
+        if self.latency:
+            time.sleep(self.latency)
+        match = SHOW_TABLES.match(statement)
+        if match:
+            db_name = match.group(1)
+            return FakeDataFrame([FakeRow(database=db_name, tableName=tbl_name, isTemporary=False)
+                                  for tbl_name in self.metastore.tbl_names(db_name)])
+        match = DESCRIBE.match(statement)
+        if match:
+            return FakeDataFrame(self.metastore.describe(match.group(1), match.group(2)))
+        if ANALYZE.match(statement):
+            return FakeDataFrame([])
+        raise ValueError("Statement not supported by FakeSparkSession: " + statement)
@@ -0,0 +1,61 @@
+# coding: utf-8
+
+# ------------------------------------------------------------------------
+# Module Name :- SMTP Sink
+# Module description : - Local SMTP server accepting and discarding every mail, for benchmarking
+#                        the delivery of hdfs_stats without a relay. Counts the mails and bytes received
+# ----------------------
+
+import socketserver
+import threading
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode('ascii'))
+
+    def handle(self):
+        self.reply("220 smtp-sink ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().upper()
+            if command.startswith("EHLO"):
+                self.wfile.write(b"250-smtp-sink\r\n250 8BITMIME\r\n")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data_line in iter(self.rfile.readline, b""):
+                    if data_line == b".\r\n":
+                        break
+                    size = size + len(data_line)
+                self.server.record(size)
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET and NOOP
+                self.reply("250 OK")
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), SinkHandler)
+        self.lock = threading.Lock()
+        self.mails, self.bytes = 0, 0
+
+    def record(self, size):
+        with self.lock:
+            self.mails, self.bytes = self.mails + 1, self.bytes + size
+
+    # Serves on a background thread, returns the (host, port) to send to
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
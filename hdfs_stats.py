@@ -3,7 +3,7 @@
 # ------------------------------------------------------------------------
 # Module Name :- HDFS Stats Generator
 # Module description : - Generates Graphical Stats for the tables in hdfs directory mentioned in the json file passed through --jsonconfig <db_config.json>
-# Parameters required :- --jsonconfig <db_config.json>
+# Parameters required :- [run|collect|render|send|validate-config|query] --jsonconfig <db_config.json>, see get_parser
 # Created by :- Jatin Chauhan
 # Created on :- 7 JULY 2019
 # Version History :- VERSION 1.4
@@ -14,106 +14,450 @@ import io
 import sys
 import math
 import json
+import html
 import base64
+import sqlite3
+import datetime
 import smtplib
+import queue
+import random
+import shutil
+import time
+import tempfile
 import argparse
-import pandas as pd
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from pyspark.sql import SparkSession
-from email.mime.text import MIMEText
-from email.utils import COMMASPACE, formatdate
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-j','--jsonconfig', help='Input the JSON file which servers as a configuratiion to HDFS Stats', default="NA")
-parser.add_argument('-c','--cssfile', help='Input the css file', default="NA")
-args = parser.parse_args()
-
-#Use this to prevent column from wrapping up data
-pd.set_option('display.max_colwidth', -1)
-spark = ""
-stats, out_dict, df_all_stats = {}, {}, ""
-
-def main():
-    module_name = os.path.basename(sys.argv[0])
+import collections
+import contextlib
+import importlib
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from email.header import Header
+from email.utils import formatdate
+
+# pandas, numpy, matplotlib, pyarrow and pyspark are imported by the functions
+# using them, so that the commands which do not need them (send,
+# validate-config) start without their import cost, and only collect starts
+# a JVM
+
+# CSS of the reports, read from --cssfile
+style = ""
+# Sections of the JSON config which are not database names
+CONFIG_SECTIONS = ["admin", "mail_format", "metastore", "chargeback"]
+COMMANDS = ["run", "collect", "render", "send", "validate-config", "query"]
+
+# Returns the command line parser, one sub parser per command:
+#   collect          collects the stats and saves them to the --export snapshot
+#   render           renders the reports of an --export snapshot into the --outbox
+#   send             delivers the mails of the --outbox
+#   validate-config  checks the JSON config
+#   query            queries an --export snapshot
+#   run              collect, render and send in one go (the default command)
+def get_parser():
+    config = argparse.ArgumentParser(add_help=False)
+    config.add_argument('-j','--jsonconfig', help='Input the JSON file which servers as a configuratiion to HDFS Stats', default="NA")
+    profile = argparse.ArgumentParser(add_help=False)
+    profile.add_argument('--profile', help='Write the run profile (phase timings, slowest tables) to this file: JSON, or Prometheus textfile for *.prom', default=None)
+    history = argparse.ArgumentParser(add_help=False)
+    history.add_argument('--history', help='Directory of the Parquet history store; enables the growth sections of the report', default=None)
+
+    collect = argparse.ArgumentParser(add_help=False)
+    collect.add_argument('-w','--workers', help='Number of threads collecting table metadata', type=int, default=8)
+    collect.add_argument('-b','--backend', help='describe: per table DESCRIBE FORMATTED through Spark (default); metastore: one bulk query per database against the "metastore" config section, without ANALYZE', choices=['describe', 'metastore'], default='describe')
+    collect.add_argument('-s','--snapshot', help='SQLite snapshot store; when given only new or changed tables are analyzed', default=None)
+    collect.add_argument('--fingerprint-mtime', help='Also treat a changed location mtime as a table change (one extra NameNode call per table)', action='store_true')
+    collect.add_argument('--size-source', help='metastore: totalSize from the table stats (default); filesystem: size of the visible files of the table location, computed on the executors (skips ANALYZE)', choices=['metastore', 'filesystem'], default='metastore')
+    collect.add_argument('--size-partitions', help='Number of Spark tasks sizing or deep scanning the locations (defaults to 4 per core of the cluster)', type=int, default=None)
+    collect.add_argument('--deep-scan', help='Walk every table location on the executors for per partition file counts and the small files section', action='store_true')
+    collect.add_argument('--small-file-mb', help='Files below this size (MB) count as small files in --deep-scan', type=int, default=128)
+    collect.add_argument('--partition-stats-csv', help='Write the per partition stats of --deep-scan to this CSV file', default=None)
+    collect.add_argument('--checkpoint', help='File recording the collected tables; a failed run restarted with it resumes where it stopped', default=None)
+    collect.add_argument('--checkpoint-every', help='Tables collected between two writes of --checkpoint', type=int, default=100)
+    collect.add_argument('--run-id', help='Identity of the run recorded in --checkpoint; the checkpoint of another run is ignored. Without it, a checkpoint over the same databases started less than --checkpoint-max-hours ago is resumed', default=None)
+    collect.add_argument('--checkpoint-max-hours', help='Age after which a --checkpoint without --run-id is no longer resumed', type=float, default=24)
+    collect.add_argument('--table-retries', help='Retry rounds, with backoff, of the tables which failed to collect', type=int, default=2)
+    collect.add_argument('--db-concurrency', help='Max tables of one database collected at a time (defaults to --workers)', type=int, default=None)
+
+    render = argparse.ArgumentParser(add_help=False)
+    render.add_argument('-c','--cssfile', help='Input the css file', default="NA")
+    render.add_argument('--chart-workers', help='Number of processes rendering the charts (defaults to the number of cores)', type=int, default=None)
+    render.add_argument('--chart-format', help='Image format of the charts', choices=['png', 'svg'], default='png')
+    render.add_argument('--profile-mail', help='Append the run profile to the admin mail', action='store_true')
+    render.add_argument('--chargeback-csv', help='Write the storage cost per owner, database, InputFormat and location prefix to this CSV file', default=None)
+
+    send = argparse.ArgumentParser(add_help=False)
+    send.add_argument('--smtp-workers', help='Number of concurrent senders, each with a pooled SMTP connection', type=int, default=4)
+    send.add_argument('--smtp-retries', help='Retries of a failed mail, with exponential backoff', type=int, default=3)
+
+    parser = argparse.ArgumentParser(description='Generates Graphical Stats for the tables in hdfs directory mentioned in the JSON config')
+    commands = parser.add_subparsers(dest='command', metavar='{' + ','.join(COMMANDS) + '}')
+    run_parser = commands.add_parser('run', parents=[config, profile, history, collect, render, send], help='Collect, render and send in one go (default)')
+    run_parser.add_argument('--export', help='Directory of the Parquet export of the stats, partitioned by database', default=None)
+    run_parser.add_argument('--outbox', help='Directory keeping the mails until they are delivered (a temporary one by default)', default=None)
+    run_parser.add_argument('--replay-outbox', help='Only deliver the mails left in --outbox, without collecting the stats', action='store_true')
+    collect_parser = commands.add_parser('collect', parents=[config, profile, history, collect], help='Collect the stats into an export snapshot')
+    collect_parser.add_argument('--export', help='Directory of the Parquet export the stats are saved to, partitioned by database', required=True)
+    render_parser = commands.add_parser('render', parents=[config, profile, history, render], help='Render the reports of an export snapshot into an outbox')
+    render_parser.add_argument('--export', help='Directory of the Parquet export written by collect', required=True)
+    render_parser.add_argument('--outbox', help='Directory the mails are queued into', required=True)
+    send_parser = commands.add_parser('send', parents=[config, profile, send], help='Deliver the mails of an outbox')
+    send_parser.add_argument('--outbox', help='Directory of the mails to deliver', required=True)
+    validate_parser = commands.add_parser('validate-config', parents=[config], help='Check the JSON config')
+    validate_parser.add_argument('-c','--cssfile', help='Also check that the css file can be read', default=None)
+    query_parser = commands.add_parser('query', help='Query an export snapshot and print the result')
+    query_parser.add_argument('export', help='Directory of the Parquet export')
+    query_parser.add_argument('--group-by', help='Aggregate by this key instead of listing tables', choices=['db_name', 'owner', 'input_format', 'location_prefix'], default=None)
+    query_parser.add_argument('--top', help='Rows returned, largest first', type=int, default=20)
+    query_parser.add_argument('--db', help='Restrict to these databases', nargs='+', default=None)
+    query_parser.add_argument('--owner', help='Restrict to the tables of this owner', default=None)
+    query_parser.add_argument('--format', help='Restrict to this InputFormat', default=None)
+    query_parser.add_argument('--location', help='Restrict to the locations starting with this prefix', default=None)
+    query_parser.add_argument('--min-gb', help='Restrict to the tables of at least this size (GB)', type=float, default=None)
+    query_parser.add_argument('--prefix-depth', help='Directories kept in the location prefixes of --group-by location_prefix', type=int, default=3)
+    return parser
+
+# Parses <argv>; without a command the arguments are those of "run", as
+# in the versions without commands
+def parse_args(argv):
+    if not argv or argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['run'] + list(argv)
+    return get_parser().parse_args(argv)
+
+# Tables collected between two writes of the checkpoint file, the age (hours)
+# after which a checkpoint without run id is stale, and the base delay between
+# the retry rounds of the failed tables
+CHECKPOINT_EVERY = 100
+CHECKPOINT_MAX_HOURS = 24
+TABLE_RETRY_BACKOFF = 5.0
+
+# Run profile filled by timed() and run_sql(), None while profiling is off:
+# {"started": <perf_counter>, "phases": {<phase>: [<secs>]},
+#  "tables": {<db>.<tbl>: <secs>}, "databases": {<db>: <secs>}}
+run_profile = None
+profile_lock = threading.Lock()
+# Returned by timed() while profiling is off, so it costs one check per call
+NO_TIMING = contextlib.nullcontext()
+PROFILE_QUANTILES = [0.5, 0.95, 0.99]
+
+def enable_profiling():
+    global run_profile
+    run_profile = {"started" : time.perf_counter(), "phases" : {}, "tables" : {}, "databases" : {}}
+
+# Times the enclosed block as one call of <phase_name>, also charged to the
+# database and table when given
+def timed(phase_name, db_name=None, tbl_name=None):
+    if run_profile is None:
+        return NO_TIMING
+    return record_timing(phase_name, db_name, tbl_name)
+
+@contextlib.contextmanager
+def record_timing(phase_name, db_name, tbl_name):
+    start = time.perf_counter()
     try:
-        param_str = args.jsonconfig
-    except Exception as e:
-        param_str = None
-    if param_str is not None and type(param_str) == str:
-        print("value of run_args for module {0} is: ".format(module_name) + param_str)
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with profile_lock:
+            run_profile["phases"].setdefault(phase_name, []).append(elapsed)
+            if db_name is not None:
+                run_profile["databases"][db_name] = run_profile["databases"].get(db_name, 0) + elapsed
+            if tbl_name is not None:
+                key = db_name + "." + tbl_name
+                run_profile["tables"][key] = run_profile["tables"].get(key, 0) + elapsed
+
+# Runs and collects a Spark SQL statement, timed as "sql: <first two words>"
+def run_sql(spark, statement, db_name=None, tbl_name=None):
+    with timed("sql: " + " ".join(statement.split(' ')[:2]).lower(), db_name, tbl_name):
+        return spark.sql(statement).collect()
+
+# Returns the run profile as a <dict>: wall time, then per phase call count,
+# total and latency quantiles, and the slowest tables and databases
+def get_profile_summary(top=10):
+    import numpy
+    with profile_lock:
+        phases = {name : sorted(durations) for name, durations in run_profile["phases"].items()}
+        tables, databases = dict(run_profile["tables"]), dict(run_profile["databases"])
+    summary = {"wall_secs" : time.perf_counter() - run_profile["started"], "phases" : {}}
+    for name, durations in phases.items():
+        quantiles = numpy.quantile(durations, PROFILE_QUANTILES)
+        summary["phases"][name] = {"count" : len(durations), "total_secs" : sum(durations),
+                                   "p50" : quantiles[0], "p95" : quantiles[1], "p99" : quantiles[2], "max" : durations[-1]}
+    summary["slowest_tables"] = sorted(tables.items(), key=lambda item: item[1], reverse=True)[:top]
+    summary["slowest_databases"] = sorted(databases.items(), key=lambda item: item[1], reverse=True)[:top]
+    return summary
+
+# Writes the run profile as JSON, or in the Prometheus textfile format when
+# <file_path> ends with .prom. The file is replaced atomically
+def write_profile(file_path, summary):
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, 'w') as out:
+        if file_path.endswith(".prom"):
+            out.write("# TYPE hdfs_stats_phase_seconds summary\n")
+            for name, phase in sorted(summary["phases"].items()):
+                label = name.replace('\\', '\\\\').replace('"', '\\"')
+                for quantile in PROFILE_QUANTILES:
+                    out.write('hdfs_stats_phase_seconds{{phase="{0}",quantile="{1}"}} {2}\n'.format(label, quantile, phase["p{0:.0f}".format(quantile * 100)]))
+                out.write('hdfs_stats_phase_seconds_sum{{phase="{0}"}} {1}\n'.format(label, phase["total_secs"]))
+                out.write('hdfs_stats_phase_seconds_count{{phase="{0}"}} {1}\n'.format(label, phase["count"]))
+            out.write("# TYPE hdfs_stats_run_seconds gauge\n")
+            out.write("hdfs_stats_run_seconds {0}\n".format(summary["wall_secs"]))
+        else:
+            json.dump(summary, out, indent=2)
+    os.replace(tmp_path, file_path)
+
+# Returns the run profile as html for the admin mail
+def get_html_profile(summary):
+    import pandas as pd
+    phases = pd.DataFrame.from_dict(summary["phases"], orient='index')
+    phases = phases.sort_values(by='total_secs', ascending=False)
+    slowest = pd.DataFrame(summary["slowest_tables"], columns=['Table', 'Seconds'])
+    return '''<br><strong>Run profile</strong> ({0:.1f}s)<br>{1}<br><strong>Slowest tables</strong><br>{2}'''.format(
+        summary["wall_secs"], phases.to_html(float_format='%.3f'), slowest.to_html(index=False, float_format='%.3f'))
+
+# Seconds before an SMTP call times out, and the base delay between retries
+SMTP_TIMEOUT = 60
+SMTP_BACKOFF = 2.0
+outbox_lock, outbox_seq = threading.Lock(), [0]
+# Bytes read at a time from the report fragments, a multiple of the 57 bytes
+# encoded on each base64 line
+MAIL_CHUNK_SIZE = 57 << 14
+
+# Returns the chunks<generator> of the attachment. <files> is the html
+# <string> or a <list> of binary report fragments, read from their start
+def iter_attachment_chunks(files, chunk_size=MAIL_CHUNK_SIZE):
+    if isinstance(files, str):
+        files = [io.BytesIO(files.encode('utf-8'))]
+    elif isinstance(files, bytes):
+        files = [io.BytesIO(files)]
+    for fragment in files:
+        fragment.seek(0)
+        for chunk in iter(lambda: fragment.read(chunk_size), b""):
+            yield chunk
+
+# Writes the chunks as 76 characters base64 lines, carrying the bytes which
+# do not fill a whole line over to the next chunk
+def write_base64_lines(write, chunks):
+    pending = b""
+    for chunk in chunks:
+        pending = pending + chunk
+        usable = len(pending) - len(pending) % 57
+        if usable:
+            write(base64.encodebytes(pending[:usable]).replace(b"\n", b"\r\n"))
+            pending = pending[usable:]
+    if pending:
+        write(base64.encodebytes(pending).replace(b"\n", b"\r\n"))
+
+# Writes the whole MIME message with <write>, one chunk of the attachment at
+# a time. Every body part is base64 encoded, so no line of the message starts
+# with a "." and it can go to the SMTP DATA command as is
+def write_mail_message(write, franchise_name, send_from, send_to, subject, email_content, files):
+    boundary = "===============" + base64.b16encode(os.urandom(8)).decode('ascii') + "=="
+    f = os.path.basename("{0} HDFS Stats.html".format(franchise_name))
+    headers = [
+        "Content-Type: multipart/mixed; boundary=\"{0}\"".format(boundary),
+        "MIME-Version: 1.0",
+        "From: " + send_from,
+        "To: " + send_to,
+        "Date: " + formatdate(localtime=True),
+        "Subject: " + Header(subject, 'utf-8').encode(linesep='\r\n'),
+        "",
+        "Please open these reports using Google Chrome!",
+        "--" + boundary,
+        "Content-Type: text/html; charset=\"utf-8\"",
+        "MIME-Version: 1.0",
+        "Content-Transfer-Encoding: base64",
+        ""]
+    write(("\r\n".join(headers) + "\r\n").encode('utf-8'))
+    write_base64_lines(write, [email_content.encode('utf-8')])
+    part_headers = [
+        "--" + boundary,
+        "Content-Type: application/octet-stream; Name=\"{0}\"".format(f),
+        "MIME-Version: 1.0",
+        "Content-Transfer-Encoding: base64",
+        "Content-Disposition: attachment; filename=\"{0}\"".format(f),
+        ""]
+    write(("\r\n".join(part_headers) + "\r\n").encode('utf-8'))
+    write_base64_lines(write, iter_attachment_chunks(files))
+    write(("--" + boundary + "--\r\n").encode('utf-8'))
+
+# Runs MAIL/RCPT/DATA on an open <smtp> connection, streaming the message
+# to the socket as it is written instead of building it in memory
+def smtp_send_streaming(smtp, send_from, recipients, write_message):
+    smtp.ehlo_or_helo_if_needed()
+    code, resp = smtp.mail(send_from)
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, send_from)
+    refused = {}
+    for recipient in recipients:
+        code, resp = smtp.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, resp)
+    if len(refused) == len(recipients):
+        smtp.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    code, resp = smtp.docmd("data")
+    if code != 354:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    write_message(smtp.send)
+    smtp.send(b"\r\n.\r\n")
+    code, resp = smtp.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+def get_recipients(send_to):
+    return [address.strip() for address in send_to.split(',') if address.strip()]
+
+# Opens an SMTP connection from the "admin" section of the JSON config.
+# Optional keys: "starttls" (default true), "smtp_user" and "smtp_password"
+def open_smtp(admin_conf):
+    smtp = smtplib.SMTP(admin_conf["server_host"], admin_conf["server_port"], timeout=SMTP_TIMEOUT)
+    if admin_conf.get("starttls", True):
+        smtp.starttls()
+    if admin_conf.get("smtp_user"):
+        smtp.login(admin_conf["smtp_user"], admin_conf["smtp_password"])
+    return smtp
+
+# Writes the mail into <outbox_dir> as <mail_id>.eml, with its envelope in
+# <mail_id>.json, so it can be delivered (or replayed) without the reports
+def queue_mail(outbox_dir, franchise_name, send_from, send_to, subject, email_content, files):
+    os.makedirs(outbox_dir, exist_ok=True)
+    with outbox_lock:
+        outbox_seq[0] = outbox_seq[0] + 1
+        mail_id = "{0}-{1:05d}".format(datetime.datetime.now().strftime('%Y%m%d%H%M%S'), outbox_seq[0])
+    with open(os.path.join(outbox_dir, mail_id + ".eml"), 'wb') as eml:
+        write_mail_message(eml.write, franchise_name, send_from, send_to, subject, email_content, files)
+    envelope = {"franchise_name" : franchise_name, "send_from" : send_from,
+                "recipients" : get_recipients(send_to), "attempts" : 0, "last_error" : None}
+    # The envelope is written last: an .eml without one is an incomplete mail
+    with open(os.path.join(outbox_dir, mail_id + ".json"), 'w') as json_file:
+        json.dump(envelope, json_file)
+    return mail_id
+
+def write_file_chunks(write, file_obj):
+    for chunk in iter(lambda: file_obj.read(MAIL_CHUNK_SIZE), b""):
+        write(chunk)
+
+# Takes a pooled SMTP connection which still answers NOOP, or opens a new one
+def acquire_smtp(smtp_pool, admin_conf):
+    while True:
         try:
-            file_name = param_str
-        except Exception as e:
-            print("Error in pyspark run_args check  module config file of {}. Following error is detected: ".format(module_name) + str(e))
-            raise e
-    else:
-        pass
-    return file_name
-
-
-# Uses smtp library to send mails
-def send_mail(franchise_name, send_from, send_to, subject, email_content, files,
-              server_host, server_port):
-    msg = MIMEMultipart()
-    msg['From'] = send_from
-    msg['To'] = send_to
-    msg['Date'] = formatdate(localtime=True)
-    msg['Subject'] = subject
-    msg.preamble = """
-    Please open these reports using Google Chrome!"""
-
-    msg.attach(MIMEText(email_content, 'html'))
-
-    f = "{0} HDFS Stats.html".format(franchise_name)
-    part = MIMEApplication(files, Name=os.path.basename(f))
-    part['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(f)
-    msg.attach(part)
-    smtp = smtplib.SMTP(server_host, server_port)
-    smtp.starttls()
-    smtp.sendmail(send_from, send_to, msg.as_string())
-    smtp.close()
-
-def fig_to_base64(fig):
+            smtp = smtp_pool.get_nowait()
+        except queue.Empty:
+            return open_smtp(admin_conf)
+        try:
+            if smtp.noop()[0] == 250:
+                return smtp
+        except (smtplib.SMTPException, OSError):
+            pass
+        smtp.close()
+
+# Sends one queued mail, retrying with exponential backoff and a fresh
+# connection on every failure. Removes it from the outbox once delivered.
+# Returns None, or the last error<string>
+def deliver_mail(outbox_dir, mail_id, admin_conf, smtp_pool, retries):
+    envelope_path = os.path.join(outbox_dir, mail_id + ".json")
+    with open(envelope_path) as json_file:
+        envelope = json.load(json_file)
+    eml_path = os.path.join(outbox_dir, mail_id + ".eml")
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(SMTP_BACKOFF * (2 ** (attempt - 1)) * (1 + random.random()))
+        envelope["attempts"] = envelope["attempts"] + 1
+        smtp = None
+        try:
+            smtp = acquire_smtp(smtp_pool, admin_conf)
+            with open(eml_path, 'rb') as eml, timed("deliver mail"):
+                smtp_send_streaming(smtp, envelope["send_from"], envelope["recipients"],
+                    lambda write: write_file_chunks(write, eml))
+            smtp_pool.put(smtp)
+            os.remove(envelope_path)
+            os.remove(eml_path)
+            print("Delivered mail for: " + str(envelope["franchise_name"]))
+            return None
+        except (smtplib.SMTPException, OSError) as e:
+            if smtp is not None:
+                smtp.close()
+            envelope["last_error"] = str(e)
+            print("Attempt {0} to deliver mail for {1} failed: {2}".format(attempt + 1, envelope["franchise_name"], e))
+    with open(envelope_path, 'w') as json_file:
+        json.dump(envelope, json_file)
+    return envelope["last_error"]
+
+# Delivers every mail of the outbox with <workers> concurrent senders sharing
+# a pool of authenticated connections. Returns {<mail_id> : <error>} of the
+# mails which are left in the outbox
+def deliver_outbox(outbox_dir, admin_conf, workers=4, retries=3):
+    mail_ids = sorted(name[:-len(".json")] for name in os.listdir(outbox_dir) if name.endswith(".json"))
+    smtp_pool, failed = queue.Queue(), {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(lambda mail_id: deliver_mail(outbox_dir, mail_id, admin_conf, smtp_pool, retries), mail_ids)
+            for mail_id, error in zip(mail_ids, results):
+                if error is not None:
+                    failed[mail_id] = error
+    finally:
+        while not smtp_pool.empty():
+            smtp = smtp_pool.get_nowait()
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+    return failed
+
+# Chart formats of render_chart -> mime type of the <img> data uri
+CHART_FORMATS = {'png' : 'image/png', 'svg' : 'image/svg+xml'}
+
+# Renders the Top 50 Tables bar chart from plain lists, so it can run in a
+# worker process. Uses a bare Figure (no pyplot state to release) laid out
+# once at its final size, instead of the tight bbox second pass
+def render_chart(table_names, sizes, chart_format='png'):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(25, 9), tight_layout=True)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.bar(range(len(sizes)), sizes, label='totalSize')
+    ax.set_xticks(range(len(table_names)))
+    ax.set_xticklabels(table_names, rotation=90, fontsize=12)
+    ax.tick_params(axis='y', labelsize=12)
+    ax.set_title("Top 50 Tables HDFS Size")
+    ax.set_xlabel("Table Name", fontsize=20)
+    ax.set_ylabel("Size  on HDFS (GB)", fontsize=20)
+    ax.legend()
     img = io.BytesIO()
-    fig.savefig(img, format='png',
-                bbox_inches='tight')
-    img.seek(0)
-    return base64.b64encode(img.getvalue())
+    fig.savefig(img, format=chart_format, dpi=72)
+    return '<img src="data:{0};base64, {1}" height="100%" >'.format(CHART_FORMATS[chart_format], base64.b64encode(img.getvalue()).decode('utf-8'))
 
-def get_convert_nan_to_zero(dataframe):
-    return dataframe.fillna(0)
+# Renders the charts of all the databases on a pool of <workers> processes.
+# Only the Top 50 names and sizes of each database are sent to the workers.
+# The workers are started from a fork server (spawned where there is none):
+# forking the driver, which runs the threads of Spark and py4j, could leave
+# the children deadlocked on locks held by those threads.
+# Returns {<db_name> : <img html>}
+def render_all_charts(df_db_name_dict_seg_stats, db_names_hdfs, workers=None, chart_format='png'):
+    chart_inputs = []
+    for db in db_names_hdfs:
+        dataframe = df_db_name_dict_seg_stats[db].sort_values(by='totalSize', ascending=False).head(50)
+        chart_inputs.append((dataframe['Table Name'].tolist(), dataframe['totalSize'].tolist(), chart_format))
+    if workers == 1:
+        charts = [render_chart(*chart_input) for chart_input in chart_inputs]
+    else:
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method)) as pool:
+            charts = list(pool.map(render_chart, *zip(*chart_inputs))) if chart_inputs else []
+    return dict(zip(db_names_hdfs, charts))
 
 def get_total_size(dataframe):
     #Get total size in TB
     total = dataframe['totalSize'].sum()
     return round(total/1024,2)
 
-def convert_kb_to_gb(dataframe, column):
-    MBFACTOR = float(1<<30) #Converts into GB
-    dataframe[column] = dataframe[column].apply(lambda z: z/MBFACTOR,2)
-    return dataframe
-
 def get_unique_owner_name(dataframe):
     unique_val = dataframe.Owner.unique()
     return unique_val
 
-def get_plot(dataframe, param_1, param_2):
-    print("GET_PLOT_DF: " + str(dataframe.head(1)))
-    dataframe = dataframe.sort_values(by='totalSize', ascending=False)
-    dataframe = dataframe.head(50)
-    ax = plt.subplots()
-    ax = dataframe[[param_1,param_2]].plot(kind='bar', title ="Top 50 Tables HDFS Size",legend=True, fontsize=12)
-    ax.set_xlabel("Table Name", fontsize=20)
-    ax.set_ylabel("Size  on HDFS (GB)", fontsize=20)
-    f = ax.figure
-    f.set_figheight(9)
-    f.set_figwidth(25)
-    return f
-
 def get_top_table(dataframe, num_of_rows):
     dataframe = dataframe.sort_values(by ='totalSize', ascending=False)
     dataframe = dataframe.head(num_of_rows)
@@ -125,24 +469,103 @@ def get_zerokb_table(dataframe):
     dataframe.rename(columns={'totalSize': 'Total Size (GB)'}, inplace=True)
     return dataframe[['Owner', 'Location']].to_html(classes='mystyle shadow p-3 mb-5 bg-white rounded')
 
-def get_text_formatted_tables(dataframe):
-    dataframe = dataframe[~dataframe['Table Name'].str.contains("ref")]
-    dataframe = dataframe[dataframe['InputFormat'] == "org.apache.hadoop.mapred.TextInputFormat"]
+# Returns the tables with the most files under the small file threshold,
+# only available after a deep scan
+def get_small_files_table(dataframe, num_of_rows):
+    dataframe = dataframe[dataframe['Small Files'] > 0]
+    dataframe = dataframe.sort_values(['Small Files', 'Small File Ratio'], ascending=False).head(num_of_rows)
+    return dataframe[['Owner', 'Location', 'Partitions', 'Files', 'Small Files', 'Small File Ratio', 'Avg File Size (MB)']].to_html(
+        classes='mystyle shadow p-3 mb-5 bg-white rounded', float_format='%.2f')
+
+def get_html_small_files(db_name, small_files_tables):
+    return '''
+        <div class="row">
+          <div class="col-sm-12">
+            <div class="card">
+              <div class="card-body">
+                <h5 class="card-title title-text">{0} Database Small Files Offenders</h5>
+                <p class="card-text">{1}</p>
+              </div>
+            </div>
+          </div>
+        </div>'''.format(db_name, small_files_tables)
+
+# Returns the chargeback card of <chargeback> from get_chargeback, with the
+# rates it was computed at
+def get_html_chargeback(title, chargeback, conf):
+    currency = str(conf["currency"])
+    chargeback = chargeback.rename(columns={'Cost': 'Cost ({0})'.format(currency), 'Conversion Savings': 'Conversion Savings ({0})'.format(currency)})
+    columns = ['Tables', 'Raw TB', 'Replicated TB', 'Cost ({0})'.format(currency), 'Text TB', 'Conversion Savings TB', 'Conversion Savings ({0})'.format(currency)]
+    rates = "Replication factor {0}, {1} {2} per TB, text to Parquet/ORC compression ratio {3}".format(
+        conf["replication_factor"], conf["cost_per_tb"], currency, conf["text_compression_ratio"])
+    return '''
+        <div class="row">
+          <div class="col-sm-12">
+            <div class="card">
+              <div class="card-body">
+                <h5 class="card-title title-text">{0}</h5>
+                <p class="border-text"><span class="text-blue">RATES:</span> {1}</p>
+                <p class="card-text">{2}</p>
+              </div>
+            </div>
+          </div>
+        </div>'''.format(title, rates, chargeback[columns].to_html(classes='mystyle shadow p-3 mb-5 bg-white rounded', float_format='%.2f'))
+
+# Returns the chargeback of every owner of the tables in <dataframe>, from
+# the run wide rollup restricted to its databases
+def get_owner_chargeback(rollup, dataframe, conf):
+    import numpy
+    import pandas as pd
+    db_rollup = rollup[rollup.index.get_level_values('DB Name').isin(dataframe['DB Name'].unique())]
+    owners = pd.Index(numpy.asarray(get_unique_owner_name(dataframe), dtype=object), name='Owner')
+    chargeback = get_chargeback(db_rollup, 'Owner', conf)
+    chargeback.index = chargeback.index.astype(object)
+    chargeback = chargeback.reindex(owners).fillna(0)
+    chargeback['Tables'] = chargeback['Tables'].astype('int64')
+    return chargeback.sort_values('Bytes', ascending=False)
+
+# Returns the Text tables of <dataframe>, but the ones whose name contains
+# <text_exclude>, the same tables as the conversion savings of get_rollup
+def get_text_formatted_tables(dataframe, text_exclude):
+    dataframe = dataframe[get_text_table_mask(dataframe, text_exclude)]
     dataframe = dataframe.sort_values(['totalSize', 'Owner'], ascending=[False, True])
     dataframe.rename(columns={'totalSize': 'Total Size (GB)'}, inplace=True)
     return dataframe[['Owner', 'Location', 'Total Size (GB)']].to_html(classes='mystyle shadow p-3 mb-5 bg-white rounded')
 
-def get_html_header(dataframe_all_stats, dataframe, franchise):
-    input_props = {
-    "db_name" : str(franchise).upper(),
-    "db_size" : str(get_total_size(dataframe)),
+# Returns the aggregates shared by all the databases of the run, computed once
+def get_report_all_props(dataframe_all_stats):
+    import pandas as pd
+    #Use this to prevent column from wrapping up data
+    pd.set_option('display.max_colwidth', None)
+    return {
     "db_all_size" : str(get_total_size(dataframe_all_stats)),
     "hdfs_location_all" : get_common_location(dataframe_all_stats),
-    "hdfs_location" : get_common_location(dataframe),
-    "top_10_tables_style" : get_top_table(dataframe, 10),
-    "zerokb_tables_style" : get_zerokb_table(dataframe),
     "style" : style
     }
+
+# Returns the aggregates of one database used by both get_html_header and
+# get_html_footer, computed once
+def get_report_props(all_props, dataframe, franchise):
+    input_props = dict(all_props)
+    input_props.update({
+    "db_name" : str(franchise).upper(),
+    "db_size" : str(get_total_size(dataframe)),
+    "hdfs_location" : get_common_location(dataframe),
+    "top_10_tables" : get_top_table(dataframe, 10),
+    "zerokb_tables" : get_zerokb_table(dataframe),
+    "text_formatted_tables" : get_text_formatted_tables(dataframe, all_props.get("chargeback_conf", CHARGEBACK_DEFAULTS)["text_exclude"]),
+    "small_files_section" : "",
+    "chargeback_section" : ""
+    })
+    if 'Small Files' in dataframe.columns:
+        input_props["small_files_section"] = get_html_small_files(input_props["db_name"], get_small_files_table(dataframe, 10))
+    if all_props.get("rollup") is not None:
+        chargeback = get_owner_chargeback(all_props["rollup"], dataframe, all_props["chargeback_conf"])
+        input_props["chargeback_section"] = get_html_chargeback(
+            "{0} Database Chargeback per Owner".format(input_props["db_name"]), chargeback, all_props["chargeback_conf"])
+    return input_props
+
+def get_html_header(input_props):
     html_buffer = '<link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/css/bootstrap.min.css" integrity="sha384-ggOyR0iXCbMQv3Xipma34MD+dH/1fQ784/j6cY/iJTQUOhcWr7x9JvoRxT2MZw1T" crossorigin="anonymous"><script src="https://code.jquery.com/jquery-3.3.1.slim.min.js" integrity="sha384-q8i/X+965DzO0rT7abK41JStQIAqVgRVzpbzo5smXKp4YfRvH+8abtTE1Pi6jizo" crossorigin="anonymous"></script><script src="https://cdnjs.cloudflare.com/ajax/libs/popper.js/1.14.7/umd/popper.min.js" integrity="sha384-UO2eT0CpHqdSJQ6hJty5KVphtPhzWj9WO1clHTMGa3JDZwrnQq4sF86dIHNDz0W1" crossorigin="anonymous"></script><script src="https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/js/bootstrap.min.js" integrity="sha384-JjSmVgyd0p3pXB1rRibZUAYoIIy6OrQ6VrjIEaFf/nJGzIxFDsf4x0xIM+B07jRM" crossorigin="anonymous"></script>'
     html_buffer = html_buffer + '''
     <style>
@@ -175,15 +598,7 @@ def get_html_header(dataframe_all_stats, dataframe, franchise):
         '''.format(**input_props)
     return html_buffer
 
-def get_html_footer(dataframe_all_stats, dataframe, franchise):
-    input_props = {
-    "db_name" : str(franchise).upper(),
-    "db_size" : str(get_total_size(dataframe)),
-    "db_all_size" : str(get_total_size(dataframe_all_stats)),
-    "top_10_tables" : get_top_table(dataframe, 10),
-    "zerokb_tables" : get_zerokb_table(dataframe),
-    "text_formatted_tables" : get_text_formatted_tables(dataframe)
-    }
+def get_html_footer(input_props):
     html_buffer = '''
         <div class="row">
           <div class="col-sm-12">
@@ -214,7 +629,7 @@ def get_html_footer(dataframe_all_stats, dataframe, franchise):
               </div>
             </div>
           </div>
-        </div>
+        </div>{small_files_section}{chargeback_section}
         <footer class="blue page-footer font-small">
 
         <div class="footer-copyright text-center py-3">© 2019 ZS:
@@ -227,22 +642,60 @@ def get_html_footer(dataframe_all_stats, dataframe, franchise):
         '''.format(**input_props)
     return html_buffer
 
+def get_html_growth(growth, projection, franchise):
+    growth = growth.sort_values(by='WoW', ascending=False).head(10)
+    growth = growth.rename(columns={'totalSize': 'Total Size (GB)', 'DoD': 'Day over Day (GB)', 'WoW': 'Week over Week (GB)'})
+    if projection is None:
+        projection_text = "Not enough history to project the growth"
+    elif projection['quota_tb'] != projection['quota_tb']: # NaN
+        projection_text = "Growing {0:.2f} GB/day, no quota configured".format(projection['slope_gb_per_day'])
+    elif projection['current_tb'] >= projection['quota_tb']:
+        projection_text = "Quota of {0} TB exceeded, {1:.2f} TB used, growing {2:.2f} GB/day".format(
+            projection['quota_tb'], projection['current_tb'], projection['slope_gb_per_day'])
+    elif projection['days_to_quota'] != projection['days_to_quota']: # NaN
+        projection_text = "Growing {0:.2f} GB/day, no quota reached at this rate".format(projection['slope_gb_per_day'])
+    else:
+        projection_text = "Growing {0:.2f} GB/day, quota of {1} TB reached in {2:.0f} days".format(
+            projection['slope_gb_per_day'], projection['quota_tb'], projection['days_to_quota'])
+    input_props = {
+    "db_name" : str(franchise).upper(),
+    "projection" : projection_text,
+    "top_growers" : growth[['Total Size (GB)', 'Day over Day (GB)', 'Week over Week (GB)']].to_html(classes='mystyle shadow p-3 mb-5 bg-white rounded', float_format='%.2f')
+    }
+    html_buffer = '''
+        <div class="row">
+          <div class="col-sm-12">
+            <div class="card">
+              <div class="card-body">
+                <h5 class="card-title title-text">{db_name} Database Growth</h5>
+                <p class="border-text"><span class="text-blue">PROJECTION:</span> {projection}</p>
+                <p class="card-text">{top_growers}</p>
+              </div>
+            </div>
+          </div>
+        </div>
+        '''.format(**input_props)
+    return html_buffer
+
+# Returns the longest directory shared by all the table locations, "" when
+# they are on different filesystems. The common path segments of all the
+# locations are the ones shared by the smallest and the largest segment
+# lists, so it runs in time linear in the input size
 def get_common_location(dataframe):
-    arr = dataframe['Location'].unique().tolist()
-    n = len(arr)
-    s = arr[0]
-    l = len(s)
-    res = ""
-    for i in range( l) :
-        for j in range( i + 1, l + 1) :
-            stem = s[i:j]
-            k = 1
-            for k in range(1, n):
-                if stem not in arr[k]:
-                    break
-            if (k + 1 == n and len(res) < len(stem)):
-                res = stem
-    return res
+    arr = dataframe['Location'].dropna().unique().tolist()
+    if len(arr) == 0:
+        return ""
+    if len(arr) == 1:
+        return arr[0]
+    segments = [location.rstrip('/').split('/') for location in arr]
+    first, last = min(segments), max(segments)
+    common = 0
+    while common < min(len(first), len(last)) and first[common] == last[common]:
+        common = common + 1
+    # "<scheme>:", "" and "<authority>" of a URI only make sense together
+    if first[0].endswith(':') and common < 3:
+        return ""
+    return '/'.join(first[:common])
 
 #Reads JSON File
 def read_from_json(file_path):
@@ -250,13 +703,40 @@ def read_from_json(file_path):
         data = json.load(json_file)
     return data
 
-def get_html(dataframe_all_stats, dataframe, franchise):
-    df_temp = get_plot(dataframe, 'Table Name', 'totalSize')
-    encoded, franchise = fig_to_base64(df_temp), franchise
-    my_html = get_html_header(dataframe_all_stats, dataframe, franchise)
-    my_html = my_html + '<img src="data:image/png;base64, {}" height="100%" >'.format(encoded.decode('utf-8'))
-    my_html = my_html + get_html_footer(dataframe_all_stats, dataframe, franchise)
-    return my_html
+# Writes the report of one database to the binary <out> file one section at
+# a time. <chart_html> is the pre-rendered chart from render_all_charts and
+# <all_props> the run wide aggregates from get_report_all_props, computed
+# here when not given
+def write_html(out, dataframe_all_stats, dataframe, franchise, chart_html, growth_html="", all_props=None):
+    if all_props is None:
+        all_props = get_report_all_props(dataframe_all_stats)
+    input_props = get_report_props(all_props, dataframe, franchise)
+    out.write(get_html_header(input_props).encode('utf-8'))
+    out.write(chart_html.encode('utf-8'))
+    out.write(growth_html.encode('utf-8'))
+    out.write(get_html_footer(input_props).encode('utf-8'))
+
+# Renders the report of every database exactly once for the run. Both the
+# franchise mails and the admin mail are assembled from the returned
+# report model {<db_name> : <binary html temp file>}. The reports are
+# written straight to disk, so the memory held by the rendered reports does
+# not grow with the number of databases
+# <rollup> from get_rollup adds the per owner chargeback to every report
+def build_report_model(db_json, db_names_hdfs, df_all_stats, df_db_name_dict_seg_stats, growth_html=None, chart_workers=None, chart_format='png',
+                       rollup=None):
+    report_model, growth_html = {}, growth_html or {}
+    all_props = get_report_all_props(df_all_stats)
+    all_props["chargeback_conf"] = get_chargeback_conf(db_json)
+    if rollup is not None:
+        all_props["rollup"] = rollup
+    with timed("render charts"):
+        charts = render_all_charts(df_db_name_dict_seg_stats, db_names_hdfs, chart_workers, chart_format)
+    for db in db_names_hdfs:
+        report_model[db] = tempfile.TemporaryFile()
+        with timed("render html", db):
+            write_html(report_model[db], df_all_stats, df_db_name_dict_seg_stats[db], db_json[db]["name"], charts.pop(db), growth_html.get(db, ""), all_props)
+        print("Rendered report for: " + str(db))
+    return report_model
 
 #Converts JSON Object into a list with only values
 def convert_json_to_list(json_obj, typ):
@@ -272,13 +752,18 @@ def convert_json_to_list(json_obj, typ):
 # Returns a db_tbl_name<list> with table names with
 # respect to the database name -> db_name
 def find_db_tbl_name(db_name, spark):
-    input_list, db_tbl_name = spark.sql("show tables in {0}".format(db_name)).collect(), []
+    input_list, db_tbl_name = run_sql(spark, "show tables in {0}".format(db_name), db_name), []
     for index in range(len(input_list)):
         db_tbl_name.append("" + input_list[index].__getitem__("database") + "." + input_list[index].__getitem__("tableName"))
     return db_tbl_name # Format -> <db_name>.<tbl_name>
 
-def filter_tbl_list(db_name, tbl_name, spark):
-    input_list = spark.sql("describe formatted {0}.{1}".format(db_name, tbl_name)).collect()
+def describe_tbl(db_name, tbl_name, spark):
+    return run_sql(spark, "describe formatted {0}.{1}".format(db_name, tbl_name), db_name, tbl_name)
+
+# Returns False for views. Reuses the <input_list> of describe_tbl when given
+def filter_tbl_list(db_name, tbl_name, spark, input_list=None):
+    if input_list is None:
+        input_list = describe_tbl(db_name, tbl_name, spark)
     for index in range(len(input_list)):
         index_val = input_list[index].__getitem__("col_name")
         if index_val == 'Type':
@@ -287,175 +772,1136 @@ def filter_tbl_list(db_name, tbl_name, spark):
                 return False
     return True
 
-#Takes DB_Name and TBL_Name as input and populates the <stats> dictionary
-# with the collected Metadata of Individual Tables
+#Takes DB_Name and TBL_Name as input and returns a <dict> with the collected
+# Metadata of the Individual Table
 def find_tbl_stats(db_name, tbl_name, spark): # Takes one TBL at a time
-    analyse = spark.sql("analyze table {0}.{1} compute statistics noscan".format(db_name, tbl_name)).collect()
-    input_list = spark.sql("describe formatted {0}.{1}".format(db_name, tbl_name)).collect()
+    analyse = run_sql(spark, "analyze table {0}.{1} compute statistics noscan".format(db_name, tbl_name), db_name, tbl_name)
+    input_list = describe_tbl(db_name, tbl_name, spark)
+    return parse_tbl_stats(input_list)
+
+# Returns the Metadata <dict> of a table from the <input_list> of describe_tbl
+def parse_tbl_stats(input_list):
     params_to_check = ['Owner','Location', 'InputFormat']
+    tbl_stats = {}
 
     for index in range(len(input_list)):
         index_val = input_list[index].__getitem__("col_name")
         if index_val in params_to_check:
             prop, val = index_val, input_list[index].__getitem__("data_type")
-            stats[db_name][tbl_name].update({prop : val})
+            tbl_stats.update({prop : val})
 
         if input_list[index].__getitem__("col_name") == 'Table Properties':
             val = input_list[index].__getitem__("data_type")
             val = string_to_dict(val) #val is now a <dict>
             if 'totalSize' in val.keys():
                 val = val['totalSize'] #vak is now validated according to 'Table Properties' requirement
-                stats[db_name][tbl_name].update({'totalSize' : val})
+                tbl_stats.update({'totalSize' : val})
             else:
                 val = 0
-                stats[db_name][tbl_name].update({'totalSize' : val})
+                tbl_stats.update({'totalSize' : val})
         if input_list[index].__getitem__("col_name") == 'Statistics':
             val = input_list[index].__getitem__("data_type")
             val = int(val.split(' ')[0])
-            stats[db_name][tbl_name].update({'totalSize' : val})
+            tbl_stats.update({'totalSize' : val})
+    tbl_stats.update({'fingerprint' : get_tbl_fingerprint(input_list)})
+    return tbl_stats
+
+# Returns the transient_lastDdlTime of the table from the <input_list> of
+# describe_tbl, which changes with every DDL/ANALYZE on the table
+def get_tbl_fingerprint(input_list):
+    for index in range(len(input_list)):
+        if input_list[index].__getitem__("col_name") == 'Table Properties':
+            props = input_list[index].__getitem__("data_type")
+            return string_to_dict(props).get('transient_lastDdlTime', '')
+    return ''
+
+# Returns the modification time of the table location, which changes when
+# files or partitions are written straight to HDFS without any DDL
+def get_location_mtime(location, spark):
+    if not location:
+        return ''
+    with timed("location mtime"):
+        jvm = spark.sparkContext._jvm
+        path = jvm.org.apache.hadoop.fs.Path(location)
+        fs = path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+        return str(fs.getFileStatus(path).getModificationTime())
 
+# Runs all the metadata probes of a single table while holding its database
+# slot. Returns None for views, <cached> when its fingerprint still matches,
+# otherwise the fresh <dict> from find_tbl_stats. Without <analyze> the
+# Metadata is parsed from the first describe_tbl call
+def collect_tbl_stats(db_name, tbl_name, spark, cached=None, location_mtime=False, analyze=True):
+    input_list = describe_tbl(db_name, tbl_name, spark)
+    if not filter_tbl_list(db_name, tbl_name, spark, input_list):
+        return None
+    if cached is not None:
+        fingerprint = get_tbl_fingerprint(input_list)
+        if location_mtime:
+            fingerprint = fingerprint + ":" + get_location_mtime(cached['Location'], spark)
+        if fingerprint == cached['fingerprint']:
+            return cached
+    tbl_stats = find_tbl_stats(db_name, tbl_name, spark) if analyze else parse_tbl_stats(input_list)
+    if location_mtime:
+        tbl_stats['fingerprint'] = tbl_stats['fingerprint'] + ":" + get_location_mtime(tbl_stats.get('Location'), spark)
+    return tbl_stats
 
 # Input -> db_names_hdfs<list> of all the database obtained from the input
-def collect_all_stats(db_names_hdfs, spark):
-    for index in range(len(db_names_hdfs)): # Iterate db wise from the db_names_hdfs<list>
-        db_name = db_names_hdfs[index]
-
-        # Returns a db_meta_list<list> with table_names in the db_name<string>
-        # one at a time
-        db_meta_list = find_db_tbl_name(db_name, spark)
-
-        # Generates the <db_name>.<tbl_name> key-value pairs in the stats<dict>
-        for stat_itr in db_meta_list:
-            db_name_meta_list = stat_itr.split('.')[0]
-            tbl_name_meta_list = stat_itr.split('.')[1]
-            if filter_tbl_list(db_name_meta_list, tbl_name_meta_list, spark):
-                if db_name_meta_list not in stats:
-                    stats[db_name_meta_list] = {}
+# Fans the per-table jobs out over a pool of <workers> threads, with at most
+# <db_concurrency> tables of the same database in flight at a time. The limit
+# is enforced when submitting: each database keeps a queue of its pending
+# tables, the first jobs are submitted round robin over the databases and
+# every completed job submits the next table of its database, so a worker
+# never waits on a database at its limit while other databases have work.
+# With a <snapshot_conn> only new or changed tables are analyzed, the others
+# are taken from the snapshot store, which is then refreshed.
+# A failing table or database does not stop the run: its error goes to
+# <errors><dict> and failed tables are retried <retries> times with backoff.
+# With a <checkpoint> file, collected tables are appended to it every
+# <checkpoint_every> tables and the tables already in it are not queried again,
+# provided the checkpoint was written over the same databases by the same
+# <run_id>, or without run id less than <checkpoint_max_hours> ago.
+# Returns the stats<dict> as {<db_name> : {<tbl_name> : {<meta> : <value>}}}
+def collect_all_stats(db_names_hdfs, spark, workers=8, db_concurrency=None, snapshot_conn=None, location_mtime=False, analyze=True,
+                      errors=None, retries=0, checkpoint=None, checkpoint_every=CHECKPOINT_EVERY, run_id=None,
+                      checkpoint_max_hours=CHECKPOINT_MAX_HOURS):
+    stats, snapshot, checkpointed = {}, {}, {}
+    errors = {} if errors is None else errors
+    db_concurrency = db_concurrency or workers
+    if checkpoint:
+        checkpointed = load_checkpoint(checkpoint, run_id, db_names_hdfs, checkpoint_max_hours)
+        if not os.path.exists(checkpoint):
+            start_checkpoint(checkpoint, run_id, db_names_hdfs)
+    to_checkpoint = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Returns a db_meta_list<list> with table_names for every db_name<string>
+        listing_jobs = [pool.submit(find_db_tbl_name, db_name, spark) for db_name in db_names_hdfs]
+
+        tbl_jobs = []
+        for db_name, listing_job in zip(db_names_hdfs, listing_jobs):
+            # Keeps the table order of "show tables" in the stats<dict>
+            stats[db_name] = {}
+            try:
+                db_meta_list = listing_job.result()
+            except Exception as e:
+                errors[db_name] = str(e)
+                print("Could not list the tables of {0}: {1}".format(db_name, e))
+                continue
+            if snapshot_conn is not None:
+                snapshot[db_name] = load_db_snapshot(snapshot_conn, db_name)
+            resumed = 0
+            for stat_itr in db_meta_list:
+                db_name_meta_list, tbl_name_meta_list = stat_itr.split('.', 1)
+                stats[db_name][tbl_name_meta_list] = None
+                if tbl_name_meta_list in checkpointed.get(db_name, {}):
+                    stats[db_name][tbl_name_meta_list] = checkpointed[db_name][tbl_name_meta_list]
+                    resumed = resumed + 1
                 else:
-                    stats[db_name_meta_list].update({tbl_name_meta_list : {} })
+                    tbl_jobs.append((db_name_meta_list, tbl_name_meta_list))
+            print("Queued {0} tables of {1}, {2} resumed from the checkpoint".format(len(db_meta_list) - resumed, db_name, resumed))
+
+        for attempt in range(retries + 1):
+            if attempt:
+                delay = TABLE_RETRY_BACKOFF * (2 ** (attempt - 1))
+                print("Retrying {0} failed tables in {1:.0f}s".format(len(tbl_jobs), delay))
+                time.sleep(delay)
+            pending, jobs = collections.OrderedDict(), {}
+            for db_name, tbl_name in tbl_jobs:
+                pending.setdefault(db_name, collections.deque()).append(tbl_name)
+            tbl_jobs = []
+
+            def submit_next(db_name):
+                tbl_name = pending[db_name].popleft()
+                cached = snapshot.get(db_name, {}).get(tbl_name)
+                jobs[pool.submit(collect_tbl_stats, db_name, tbl_name, spark, cached, location_mtime, analyze)] = (db_name, tbl_name)
+
+            for slot in range(db_concurrency):
+                for db_name in pending:
+                    if pending[db_name]:
+                        submit_next(db_name)
+
+            # Results are merged on this thread only, so the workers share no state
+            while jobs:
+                done = wait(jobs, return_when=FIRST_COMPLETED)[0]
+                for job in done:
+                    db_name, tbl_name = jobs.pop(job)
+                    if pending[db_name]:
+                        submit_next(db_name)
+                    try:
+                        stats[db_name][tbl_name] = job.result()
+                    except Exception as e:
+                        errors[db_name + "." + tbl_name] = str(e)
+                        tbl_jobs.append((db_name, tbl_name))
+                        continue
+                    errors.pop(db_name + "." + tbl_name, None)
+                    if checkpoint:
+                        to_checkpoint.append((db_name, tbl_name, stats[db_name][tbl_name]))
+                        if len(to_checkpoint) >= checkpoint_every:
+                            append_checkpoint(checkpoint, to_checkpoint)
+                            to_checkpoint = []
+            if not tbl_jobs:
+                break
+        if checkpoint:
+            append_checkpoint(checkpoint, to_checkpoint)
+
+    for db_name, tbl_name in tbl_jobs:
+        print("Could not collect {0}.{1}: {2}".format(db_name, tbl_name, errors[db_name + "." + tbl_name]))
+
+    # Drops the views which were filtered out by filter_tbl_list and the failed tables
+    for db_name in stats:
+        stats[db_name] = {tbl : tbl_stats for tbl, tbl_stats in stats[db_name].items() if tbl_stats is not None}
+        if snapshot_conn is not None and db_name not in errors:
+            reused = sum(1 for tbl, tbl_stats in stats[db_name].items() if tbl_stats is snapshot[db_name].get(tbl))
+            print("Reused {0} of {1} tables of {2} from the snapshot".format(reused, len(stats[db_name]), db_name))
+            # Replaces the snapshot of the database, evicting dropped tables.
+            # A table which failed to collect keeps its previous row, so a
+            # transient failure does not cost a full ANALYZE in the next run
+            snapshot_stats = dict(stats[db_name])
+            for tbl, tbl_stats in snapshot[db_name].items():
+                if db_name + "." + tbl in errors:
+                    snapshot_stats[tbl] = tbl_stats
+            save_db_snapshot(snapshot_conn, db_name, snapshot_stats)
+    return stats
+
+# Returns {<db_name> : {<tbl_name> : <stats>}} of the tables collected in a
+# previous run, <stats> being None for views. The first line of the checkpoint
+# holds the run id, start time and databases of the run which wrote it. It is
+# resumed when it covers the same <db_names> and either has the same
+# <run_id>, or neither has a run id and it was started less than
+# <max_hours> ago, so a nightly run restarted after midnight still resumes.
+# Any other checkpoint is removed and an empty dict returned. A last line
+# torn by a crash is cut off the file, so the entries appended by the resumed
+# run start on a line of their own, and any other unreadable line is skipped
+def load_checkpoint(file_path, run_id, db_names, max_hours=CHECKPOINT_MAX_HOURS):
+    checkpointed = {}
+    if not os.path.exists(file_path):
+        return checkpointed
+    with open(file_path, 'rb+') as checkpoint_file:
+        data = checkpoint_file.read()
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            checkpoint_file.truncate(complete)
+    lines = data[:complete].decode('utf-8', 'replace').splitlines()
+    try:
+        header = json.loads(lines[0])
+        started = datetime.datetime.fromisoformat(header["started"])
+    except (IndexError, ValueError, KeyError, TypeError):
+        header, started = {}, None
+    matches = header.get("databases") == sorted(db_names) and header.get("run") == run_id
+    if matches and run_id is None:
+        matches = datetime.datetime.now() - started <= datetime.timedelta(hours=max_hours)
+    if not matches:
+        print("Ignoring the checkpoint {0} of another run".format(file_path))
+        os.remove(file_path)
+        return checkpointed
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        checkpointed.setdefault(entry["db"], {})[entry["tbl"]] = entry["stats"]
+    return checkpointed
+
+# Starts a new checkpoint file with the header identifying the run
+def start_checkpoint(file_path, run_id, db_names):
+    header = {"run" : run_id, "started" : datetime.datetime.now().isoformat(), "databases" : sorted(db_names)}
+    with open(file_path, 'w') as checkpoint_file:
+        checkpoint_file.write(json.dumps(header) + "\n")
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+
+# Appends [(<db_name>, <tbl_name>, <stats>)] to the checkpoint file and
+# syncs it to disk
+def append_checkpoint(file_path, entries):
+    if not entries:
+        return
+    with open(file_path, 'a') as checkpoint_file:
+        for db_name, tbl_name, tbl_stats in entries:
+            checkpoint_file.write(json.dumps({"db" : db_name, "tbl" : tbl_name, "stats" : tbl_stats}) + "\n")
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
 
-        for tbls_names_meta_list in stats[db_name].keys():
-            find_tbl_stats(db_name, tbls_names_meta_list, spark)
+# Returns the html list of the tables and databases which could not be collected
+def get_html_errors(errors):
+    items = "".join("<li>{0}: {1}</li>".format(html.escape(key), html.escape(error)) for key, error in sorted(errors.items()))
+    return "<br><strong>Not collected ({0})</strong><ul>{1}</ul>".format(len(errors), items)
 
-        out_dict = {}
-        for db_index in stats.keys():
-            collect_db_stat(db_name)
+# Names of files and directories skipped by Hive when it sums the table size
+def is_hidden_path(name):
+    return name.startswith('_') or name.startswith('.')
+
+# Opens the filesystem of a table location through pyarrow, which works on
+# the executors where there is no JVM. Returns (<filesystem>, <path>)
+def open_location_fs(location):
+    import pyarrow.fs
+    if location.startswith('/'):
+        location = 'file://' + location
+    return pyarrow.fs.FileSystem.from_uri(location)
+
+# Runs on the executors: yields (<partition>, <bytes>) for every visible
+# file under <location>, where <partition> is the directory of the file
+# relative to the location ("" for the location itself). Only one directory
+# listing is held at a time, plus the directories still to be listed
+def walk_location_files(location):
+    import pyarrow.fs
+    fs, path = open_location_fs(location)
+    path = path.rstrip('/')
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        partition = directory[len(path):].lstrip('/')
+        for info in fs.get_file_info(pyarrow.fs.FileSelector(directory, allow_not_found=True)):
+            if is_hidden_path(info.base_name):
+                continue
+            if info.type == pyarrow.fs.FileType.Directory:
+                pending.append(info.path)
+            elif info.type == pyarrow.fs.FileType.File:
+                yield (partition, info.size)
+
+# Runs on the executors: returns [(<partition>, <files>, <bytes>, <small files>)]
+# of <location>, small files being the ones under <small_file_bytes>
+def scan_location_partitions(location, small_file_bytes):
+    partitions = {}
+    for partition, size in walk_location_files(location):
+        counts = partitions.setdefault(partition, [0, 0, 0])
+        counts[0], counts[1] = counts[0] + 1, counts[1] + size
+        if size < small_file_bytes:
+            counts[2] = counts[2] + 1
+    return [(partition, counts[0], counts[1], counts[2]) for partition, counts in partitions.items()]
+
+# mapPartitions function: yields (<location>, <partition>, <files>, <bytes>,
+# <small files>, None) for every partition directory of the locations,
+# (<location>, None, 0, 0, 0, None) for a location scanned without any file
+# and (<location>, None, 0, 0, 0, <error>) for a location which could not be
+# scanned, so the driver learns about it
+def deep_scan_locations(locations, small_file_bytes):
+    for location in locations:
+        try:
+            partitions = scan_location_partitions(location, small_file_bytes)
+        except (OSError, ValueError) as e:
+            yield (location, None, 0, 0, 0, str(e).split("\n")[0])
+            continue
+        for partition_stats in partitions:
+            yield (location,) + partition_stats + (None,)
+        if not partitions:
+            yield (location, None, 0, 0, 0, None)
+
+# Walks the location of every row of out_dict<dict> on the executors.
+# Returns a <DataFrame> with one row per partition directory of each table.
+# With <update_sizes> the totalSize of every row of out_dict whose location
+# was scanned is replaced with the bytes of its files, as collect_location_sizes
+# does. The tables whose location could not be scanned go to <errors><dict>
+def collect_partition_stats(out_dict, spark, small_file_bytes, num_slices=None, update_sizes=False, errors=None):
+    import pandas as pd
+    errors = {} if errors is None else errors
+    locations = sorted(set(row[3] for row in out_dict.values() if row[3]))
+    columns = ['Location', 'Partition', 'Files', 'Bytes', 'Small Files', 'Error']
+    if locations:
+        num_slices = num_slices or min(len(locations), spark.sparkContext.defaultParallelism * 4)
+        rows = spark.sparkContext.parallelize(locations, num_slices).mapPartitions(
+            lambda partition_locations: deep_scan_locations(partition_locations, small_file_bytes)).collect()
+    else:
+        rows = []
+    partition_stats = pd.DataFrame(rows, columns=columns)
+    failed = partition_stats[partition_stats['Error'].notna()]
+    record_location_errors(out_dict, dict(zip(failed['Location'], failed['Error'])), locations, "scan", errors)
+    partition_stats = partition_stats[partition_stats['Error'].isna()].drop(columns=['Error'])
+    if update_sizes:
+        sizes = partition_stats.groupby('Location')['Bytes'].sum()
+        for row in out_dict.values():
+            if row[3] in sizes.index:
+                row[4] = int(sizes[row[3]])
+    partition_stats = partition_stats[partition_stats['Partition'].notna()]
+    tables = pd.DataFrame([row[:2] + [row[3]] for row in out_dict.values()], columns=['DB Name', 'Table Name', 'Location'])
+    partition_stats = tables.merge(partition_stats, on='Location')
+    partition_stats['Avg File Size (MB)'] = partition_stats['Bytes'] / partition_stats['Files'] / float(1<<20)
+    partition_stats['Small File Ratio'] = partition_stats['Small Files'] / partition_stats['Files']
+    return partition_stats
+
+# Rolls the partition stats up to one row per table, indexed like df_all_stats
+def get_table_file_stats(partition_stats):
+    grouped = partition_stats.groupby(['DB Name', 'Table Name'])
+    table_stats = grouped[['Files', 'Bytes', 'Small Files']].sum()
+    table_stats['Partitions'] = grouped.size()
+    table_stats['Avg File Size (MB)'] = table_stats['Bytes'] / table_stats['Files'] / float(1<<20)
+    table_stats['Small File Ratio'] = table_stats['Small Files'] / table_stats['Files']
+    table_stats.index = [db + "." + tbl for db, tbl in table_stats.index]
+    return table_stats.drop(columns=['Bytes'])
+
+# Runs on the executors: returns the total bytes of the visible files under
+# <location>, the content summary of the location without the hidden files
+# Hive skips, so it counts what the deep scan counts
+def get_location_size(location):
+    return sum(size for partition, size in walk_location_files(location))
+
+# mapPartitions function: yields (<location>, <bytes>, <error>) for every
+# location of the partition, <bytes> being None when it could not be read
+def size_locations(locations):
+    for location in locations:
+        try:
+            yield (location, get_location_size(location), None)
+        except (OSError, ValueError) as e:
+            yield (location, None, str(e).split("\n")[0])
+
+# Records in <errors><dict> the tables of out_dict<dict> whose location is in
+# <failed><dict> {<location> : <error>}, which keep their metastore size.
+# Raises when no location at all could be read, which means the executors
+# cannot reach the filesystem rather than a few bad locations
+def record_location_errors(out_dict, failed, locations, action, errors):
+    if failed and len(failed) == len(locations):
+        location, error = sorted(failed.items())[0]
+        raise RuntimeError("Could not {0} any of the {1} table locations, e.g. {2}: {3}".format(action, len(locations), location, error))
+    for row in out_dict.values():
+        if row[3] in failed:
+            print("Could not {0} {1}: {2}".format(action, row[3], failed[row[3]]))
+            errors[row[0] + "." + row[1]] = "could not {0} {1}: {2}".format(action, row[3], failed[row[3]])
+
+# Replaces the totalSize of every row of out_dict<dict> with the size of its
+# location read from the filesystem, on the executors as Spark tasks. This
+# covers tables with missing or stale metastore stats. The tables whose
+# location could not be read go to <errors><dict>
+def collect_location_sizes(out_dict, spark, num_slices=None, errors=None):
+    errors = {} if errors is None else errors
+    locations = sorted(set(row[3] for row in out_dict.values() if row[3]))
+    if not locations:
+        return out_dict
+    num_slices = num_slices or min(len(locations), spark.sparkContext.defaultParallelism * 4)
+    rows = spark.sparkContext.parallelize(locations, num_slices).mapPartitions(size_locations).collect()
+    sizes = {location : size for location, size, error in rows if error is None}
+    record_location_errors(out_dict, {location : error for location, size, error in rows if error is not None}, locations, "size", errors)
+    for row in out_dict.values():
+        if row[3] in sizes:
+            row[4] = sizes[row[3]]
+    return out_dict
+
+# Opens (and creates if needed) the SQLite snapshot store keeping the last
+# known metadata of every table, keyed by <db_name>.<tbl_name>
+def open_snapshot_store(file_path):
+    conn = sqlite3.connect(file_path)
+    conn.execute("""CREATE TABLE IF NOT EXISTS table_snapshot (
+        db_tbl_name TEXT PRIMARY KEY, db_name TEXT NOT NULL, tbl_name TEXT NOT NULL,
+        owner TEXT, location TEXT, total_size INTEGER, input_format TEXT,
+        fingerprint TEXT, collected_at TEXT)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS table_snapshot_db ON table_snapshot (db_name)")
+    conn.commit()
+    return conn
+
+# Returns {<tbl_name> : {<meta> : <value>}} for the database from the snapshot store
+def load_db_snapshot(conn, db_name):
+    rows = conn.execute("SELECT tbl_name, owner, location, total_size, input_format, fingerprint "
+                        "FROM table_snapshot WHERE db_name = ?", (db_name,)).fetchall()
+    return {row[0] : {'Owner' : row[1], 'Location' : row[2], 'totalSize' : row[3],
+                      'InputFormat' : row[4], 'fingerprint' : row[5]} for row in rows}
+
+# Replaces all the rows of the database in the snapshot store with <db_stats>
+def save_db_snapshot(conn, db_name, db_stats):
+    collected_at = datetime.datetime.now().isoformat()
+    with conn:
+        conn.execute("DELETE FROM table_snapshot WHERE db_name = ?", (db_name,))
+        conn.executemany("INSERT INTO table_snapshot VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(db_name + "." + tbl, db_name, tbl, tbl_stats.get('Owner'), tbl_stats.get('Location'),
+              int(tbl_stats.get('totalSize') or 0), tbl_stats.get('InputFormat'),
+              tbl_stats.get('fingerprint'), collected_at) for tbl, tbl_stats in db_stats.items()])
 
 # Input -> parent<string> which is the DataBase name
-def collect_db_stat(parent):
-    parent_key, out_list = parent, []
+# Adds one row per table of the database to out_dict<dict>
+def collect_db_stat(parent, stats, out_dict):
+    parent_key = parent
+    param_list = ['Owner','Location','totalSize', 'InputFormat']
     for tb_ind in stats[parent_key].keys():
-        for meta in stats[parent_key][tb_ind].keys():
-            out_key, out_list = parent_key + "." + tb_ind, []
-            out_list.append(parent_key)
-            out_list.append(tb_ind)
+        out_key, out_list = parent_key + "." + tb_ind, [parent_key, tb_ind]
+        for param_list_item in param_list:
+            out_list.append(stats[parent_key][tb_ind].get(param_list_item))
+        out_dict.update({out_key:out_list})
+    return out_dict
+
+# Bulk variant of find_tbl_stats/filter_tbl_list for one whole database. Reads
+# Owner, Location, InputFormat and totalSize straight from the Hive metastore
+# tables, skipping views. Partitioned tables without a table level totalSize
+# fall back to the sum of their partitions' totalSize. {q} quotes the
+# identifiers and {bigint} is the integer type of CAST in the dialect of the
+# metastore RDBMS, {param} is the placeholder of the database name
+METASTORE_DB_STATS_QUERY = """
+SELECT d.{q}NAME{q}, t.{q}TBL_NAME{q}, t.{q}OWNER{q}, s.{q}LOCATION{q},
+       COALESCE(CAST(tp.{q}PARAM_VALUE{q} AS {bigint}), pp.{q}TOTAL_SIZE{q}, 0), s.{q}INPUT_FORMAT{q}
+FROM {q}TBLS{q} t
+JOIN {q}DBS{q} d ON d.{q}DB_ID{q} = t.{q}DB_ID{q}
+LEFT JOIN {q}SDS{q} s ON s.{q}SD_ID{q} = t.{q}SD_ID{q}
+LEFT JOIN {q}TABLE_PARAMS{q} tp ON tp.{q}TBL_ID{q} = t.{q}TBL_ID{q} AND tp.{q}PARAM_KEY{q} = 'totalSize'
+LEFT JOIN (SELECT p.{q}TBL_ID{q}, SUM(CAST(ppv.{q}PARAM_VALUE{q} AS {bigint})) AS {q}TOTAL_SIZE{q}
+           FROM {q}PARTITIONS{q} p
+           JOIN {q}PARTITION_PARAMS{q} ppv ON ppv.{q}PART_ID{q} = p.{q}PART_ID{q} AND ppv.{q}PARAM_KEY{q} = 'totalSize'
+           GROUP BY p.{q}TBL_ID{q}) pp ON pp.{q}TBL_ID{q} = t.{q}TBL_ID{q}
+WHERE d.{q}NAME{q} = {param} AND t.{q}TBL_TYPE{q} NOT IN ('VIRTUAL_VIEW', 'MATERIALIZED_VIEW')
+ORDER BY t.{q}TBL_NAME{q}
+"""
+
+# SQL dialects of the metastore RDBMS. Hive creates the metastore tables of
+# PostgreSQL with quoted upper case names, and MySQL only casts to SIGNED
+METASTORE_DIALECTS = {'mysql': {'q': '', 'bigint': 'SIGNED'}, 'postgresql': {'q': '"', 'bigint': 'BIGINT'}}
+# Drivers whose dialect is not the default mysql one
+METASTORE_DRIVER_DIALECTS = {'psycopg2': 'postgresql', 'psycopg': 'postgresql', 'pg8000': 'postgresql'}
 
-            param_list = ['Owner','Location','totalSize', 'InputFormat']
+# DB-API paramstyle -> placeholder used for the database name
+METASTORE_PLACEHOLDERS = {'qmark': '?', 'numeric': ':1', 'named': ':db_name', 'format': '%s', 'pyformat': '%(db_name)s'}
 
-            for param_list_item in param_list:
-                out_list.append(stats[parent_key][tb_ind][param_list_item])
+# Returns the dialect of the "metastore" config section: its "dialect" key,
+# else the one of its driver
+def get_metastore_dialect(metastore_conf):
+    dialect = metastore_conf.get("dialect", METASTORE_DRIVER_DIALECTS.get(metastore_conf["driver"], 'mysql'))
+    if dialect not in METASTORE_DIALECTS:
+        raise Exception("Unsupported metastore dialect {0}, use one of {1}".format(dialect, ", ".join(sorted(METASTORE_DIALECTS))))
+    return dialect
 
-            out_dict.update({out_key:out_list})
+# Opens a DB-API connection to the metastore RDBMS described by the "metastore"
+# section of the JSON config, e.g.
+# {"driver": "pymysql", "connect": {"host": "...", "user": "...", "password": "...", "database": "hive"}}
+# with an optional "dialect" (mysql or postgresql) for drivers not in
+# METASTORE_DRIVER_DIALECTS
+def connect_metastore(metastore_conf):
+    driver = importlib.import_module(metastore_conf["driver"])
+    return driver, driver.connect(**metastore_conf.get("connect", {}))
 
+# Adds one row per table of db_name<string> to out_dict<dict>, in the same
+# shape as collect_db_stat, using a single metastore query
+def read_db_stats_from_metastore(db_name, conn, paramstyle, out_dict, dialect='mysql'):
+    placeholder = METASTORE_PLACEHOLDERS.get(paramstyle, '%s')
+    params = {'db_name': db_name} if paramstyle in ('named', 'pyformat') else (db_name,)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(METASTORE_DB_STATS_QUERY.format(param=placeholder, **METASTORE_DIALECTS[dialect]), params)
+        for row in cursor.fetchall():
+            out_dict.update({row[0] + "." + row[1] : list(row)})
+    finally:
+        cursor.close()
+    return out_dict
+
+# Input -> db_names_hdfs<list> of all the database obtained from the input
+# Returns the out_dict<dict> for all the databases, one metastore query each
+def collect_all_stats_from_metastore(db_names_hdfs, metastore_conf):
+    out_dict = {}
+    dialect = get_metastore_dialect(metastore_conf)
+    driver, conn = connect_metastore(metastore_conf)
+    try:
+        for db_name in db_names_hdfs:
+            with timed("metastore query", db_name):
+                read_db_stats_from_metastore(db_name, conn, getattr(driver, 'paramstyle', 'format'), out_dict, dialect)
+            print("Read metastore stats for: " + str(db_name))
+    finally:
+        conn.close()
+    return out_dict
+
+# Re-indexes the Dataframe from <db_name>.<tbl_name> to <tbl_name>
 def clean_indexes(db_name_dict_seg, db_index):
-    for idx in db_name_dict_seg.index:
-        tbl = idx.split('.')[1]
-        db_name_dict_seg = db_name_dict_seg.rename(index={idx: tbl})
+    db_name_dict_seg = db_name_dict_seg.copy()
+    db_name_dict_seg.index = db_name_dict_seg['Table Name'].values
     return db_name_dict_seg
 
+# Splits df_all_stats into one <DataFrame> per database in a single groupby
+# pass, indexed by <tbl_name>
 def segregate_df_on_db(db_name_dict, df_all_stats): #Input as list
     db_name_dict_seg = {}
+    groups = dict(tuple(df_all_stats.groupby('DB Name', observed=True, sort=False)))
     for db_index in db_name_dict:
-        print("Creating an Empty <dict> for: " + str(db_index))
-        db_name_dict_seg[db_index] = {}
-        db_name_dict_seg[db_index] = df_all_stats[df_all_stats['DB Name'] == db_index]
-        print("Cleaning Indexes of the Dataframe: <db_name>.<tb_name> to <tb_name>")
-        db_df_temp = db_name_dict_seg[db_index]
-        db_df_temp = clean_indexes(db_df_temp, db_index)
-        db_name_dict_seg[db_index] = db_df_temp
+        db_df_temp = groups.get(db_index, df_all_stats.iloc[0:0])
+        db_name_dict_seg[db_index] = clean_indexes(db_df_temp, db_index)
         print("Segregated for: " + str(db_index))
     return db_name_dict_seg
 
+# Columns of the rows in out_dict, see collect_db_stat
+STATS_COLUMNS = ['DB Name', 'Table Name', 'Owner', 'Location', 'totalSize', 'InputFormat']
+
+# Builds df_all_stats from the collected rows<list> in one columnar pass:
+# categorical DB Name/Owner/InputFormat, int64 'totalBytes', 'totalSize' in
+# GB and a <db_name>.<tbl_name> index
+def build_stats_frame(records):
+    import numpy
+    import pandas as pd
+    table = numpy.empty((len(records), len(STATS_COLUMNS)), dtype=object)
+    if len(records):
+        table[:] = records
+    columns = {column : pd.Series(table[:, index]) for index, column in enumerate(STATS_COLUMNS)}
+    total_bytes = pd.to_numeric(columns['totalSize'], errors='coerce').fillna(0).astype('int64').values
+    dataframe = pd.DataFrame({
+        'DB Name' : pd.Categorical(columns['DB Name']),
+        'Table Name' : columns['Table Name'].values,
+        'Owner' : pd.Categorical(columns['Owner'].fillna('')),
+        'Location' : columns['Location'].fillna('').values,
+        'totalSize' : total_bytes / float(1<<30),
+        'InputFormat' : pd.Categorical(columns['InputFormat'].fillna('')),
+        'totalBytes' : total_bytes
+    })
+    dataframe.index = dataframe['DB Name'].astype('object') + "." + dataframe['Table Name']
+    return dataframe
+
+# Parses "[key1=val1, key2=val2]" into a <dict>, skipping the pieces without
+# a "=" which come from values containing commas
 def string_to_dict(str_list):
     str_out_dict = {}
     str_out_list = str_list.replace(' ', '').replace('[', '').replace(']', '')
     str_out_list = str_out_list.split(',')
     for list_item in str_out_list:
-        list_key_val = list_item.split('=')
+        list_key_val = list_item.split('=', 1)
+        if len(list_key_val) < 2:
+            continue
         list_key, list_val = list_key_val[0], list_key_val[1]
         str_out_dict.update({list_key : list_val})
     return str_out_dict
 
-def convert_clm_to_numeric(dataframe):
-    dataframe['totalSize'] = dataframe['totalSize'].apply(pd.to_numeric)
+# Columns of df_all_stats kept in the history store
+HISTORY_COLUMNS = ['DB Name', 'Table Name', 'Owner', 'InputFormat', 'totalSize']
+
+# Appends df_all_stats to the history store as one Parquet partition per run:
+# <history_dir>/run_date=<YYYY-MM-DD>/stats.parquet. Re-runs on the same day
+# replace that day's partition
+def append_history(dataframe, history_dir, run_date):
+    part_dir = os.path.join(history_dir, "run_date={0}".format(run_date))
+    os.makedirs(part_dir, exist_ok=True)
+    history = dataframe[HISTORY_COLUMNS].reset_index(drop=True)
+    for column in ['DB Name', 'Owner', 'InputFormat']:
+        history[column] = history[column].astype('category')
+    history.to_parquet(os.path.join(part_dir, "stats.parquet"), index=False)
+
+# Returns the sorted run dates<list> of the history store, from the partition names
+def get_history_dates(history_dir):
+    if not os.path.isdir(history_dir):
+        return []
+    return sorted(name.split('=', 1)[1] for name in os.listdir(history_dir) if name.startswith("run_date="))
+
+def open_history(history_dir):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    partitioning = ds.partitioning(pa.schema([("run_date", pa.string())]), flavor="hive")
+    return ds.dataset(history_dir, format="parquet", partitioning=partitioning)
+
+# Returns a <DataFrame> indexed by (DB Name, Table Name) with the latest
+# totalSize and its growth against the previous run (DoD) and against the
+# latest run at least 7 days older (WoW). Only those 3 partitions are read
+def get_table_growth(history_dir):
+    import pandas as pd
+    import pyarrow.dataset as ds
+    dates = get_history_dates(history_dir)
+    if len(dates) < 2:
+        return None
+    last = dates[-1]
+    week_limit = (datetime.date.fromisoformat(last) - datetime.timedelta(days=7)).isoformat()
+    week = [date for date in dates if date <= week_limit]
+    week = week[-1] if week else dates[0]
+    table = open_history(history_dir).to_table(columns=['DB Name', 'Table Name', 'totalSize', 'run_date'],
+                                               filter=ds.field('run_date').isin([last, dates[-2], week]))
+    sizes = table.to_pandas().set_index(['DB Name', 'Table Name', 'run_date'])['totalSize'].unstack('run_date')
+    # Tables missing from the latest run were dropped, new ones grew from 0
+    sizes = sizes[sizes[last].notna()].fillna(0)
+    return pd.DataFrame({'totalSize' : sizes[last],
+                         'DoD' : sizes[last] - sizes[dates[-2]],
+                         'WoW' : sizes[last] - sizes[week]})
+
+# Returns a <DataFrame> indexed by DB Name with the least squares growth of
+# the database size over all the runs (GB/day) and the days left until its
+# "quota_tb" from <quotas><dict> is reached at that rate
+def get_db_projection(history_dir, quotas):
+    import pandas as pd
+    if len(get_history_dates(history_dir)) < 2:
+        return None
+    table = open_history(history_dir).to_table(columns=['DB Name', 'totalSize', 'run_date'])
+    totals = table.group_by(['DB Name', 'run_date']).aggregate([('totalSize', 'sum')]).to_pandas()
+    totals['x'] = (pd.to_datetime(totals['run_date']) - pd.Timestamp(get_history_dates(history_dir)[0])).dt.days
+    totals['y'] = totals['totalSize_sum']
+    totals['xy'], totals['xx'] = totals['x'] * totals['y'], totals['x'] * totals['x']
+    sums = totals.groupby('DB Name')[['x', 'y', 'xy', 'xx']].sum()
+    sums['n'] = totals.groupby('DB Name').size()
+    latest = totals.sort_values('x').groupby('DB Name')['y'].last()
+    slope = (sums['n'] * sums['xy'] - sums['x'] * sums['y']) / (sums['n'] * sums['xx'] - sums['x'] ** 2)
+    projection = pd.DataFrame({'slope_gb_per_day' : slope.fillna(0), 'current_tb' : latest / 1024})
+    projection['quota_tb'] = pd.Series(quotas, dtype='float64').reindex(projection.index)
+    days = (projection['quota_tb'] - projection['current_tb']) * 1024 / projection['slope_gb_per_day']
+    projection['days_to_quota'] = days.where(projection['slope_gb_per_day'] > 0)
+    return projection
+
+# Returns the growth html section of every database in <db_names_hdfs>
+def get_growth_html(db_json, db_names_hdfs, history_dir):
+    growth = get_table_growth(history_dir)
+    projection = get_db_projection(history_dir, {db : db_json[db].get("quota_tb") for db in db_names_hdfs})
+    if growth is None:
+        return {}
+    growth_html = {}
+    for db in db_names_hdfs:
+        db_growth = growth.xs(db, level='DB Name') if db in growth.index.get_level_values('DB Name') else growth.iloc[0:0]
+        db_projection = projection.loc[db] if db in projection.index else None
+        growth_html[db] = get_html_growth(db_growth, db_projection, db_json[db]["name"])
+    return growth_html
+
+# Columns of df_all_stats in the export, under their exported names. The
+# export schema is fixed: columns missing from df_all_stats (the file counts
+# without --deep-scan) are written as nulls
+EXPORT_COLUMNS = [('Table Name', 'table_name'), ('Owner', 'owner'), ('Location', 'location'), ('InputFormat', 'input_format'),
+                  ('totalBytes', 'total_bytes'), ('totalSize', 'total_size_gb'), ('Partitions', 'partitions'),
+                  ('Files', 'files'), ('Small Files', 'small_files'), ('Avg File Size (MB)', 'avg_file_mb'),
+                  ('Small File Ratio', 'small_file_ratio')]
+EXPORT_GROUP_KEYS = ['db_name', 'owner', 'input_format', 'location_prefix']
+
+def get_export_schema():
+    import pyarrow as pa
+    return pa.schema([('table_name', pa.string()), ('owner', pa.string()), ('location', pa.string()),
+                      ('input_format', pa.string()), ('total_bytes', pa.int64()), ('total_size_gb', pa.float64()),
+                      ('partitions', pa.int64()), ('files', pa.int64()), ('small_files', pa.int64()),
+                      ('avg_file_mb', pa.float64()), ('small_file_ratio', pa.float64()), ('db_name', pa.string())])
+
+def get_export_partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([('db_name', pa.string())]), flavor="hive")
+
+# Writes df_all_stats to <export_dir> as one Parquet partition per database:
+# <export_dir>/db_name=<db>/stats-0.parquet. Tables are sorted by size so the
+# row group statistics let size filters skip whole row groups. A re-export
+# replaces the partitions of the exported databases
+def export_stats(dataframe, export_dir):
+    import numpy
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    schema = get_export_schema()
+    dataframe = dataframe.sort_values('totalBytes', ascending=False)
+    columns = {'db_name' : pa.array(dataframe['DB Name'].astype('object').values, pa.string())}
+    for column, name in EXPORT_COLUMNS:
+        if column in dataframe.columns:
+            columns[name] = pa.array(numpy.asarray(dataframe[column].astype('object') if name in ('owner', 'input_format') else dataframe[column]),
+                                     schema.field(name).type)
+        else:
+            columns[name] = pa.nulls(len(dataframe), schema.field(name).type)
+    table = pa.Table.from_pydict(columns, schema=schema)
+    ds.write_dataset(table, export_dir, format="parquet", partitioning=get_export_partitioning(), basename_template="stats-{i}.parquet",
+                     existing_data_behavior="delete_matching", max_rows_per_group=1 << 17)
+
+# Returns the location prefixes<pyarrow array> of the <locations> strings: the
+# scheme and authority followed by the first <depth> directories of the path
+def get_location_prefixes(locations, depth):
+    import pyarrow.compute as pc
+    pattern = r'^(?P<prefix>(?:[a-zA-Z][a-zA-Z0-9+.-]*://[^/]*)?(?:/[^/]+){0,%d})' % depth
+    return pc.struct_field(pc.extract_regex(locations, pattern=pattern), [0])
+
+# Opens the export of <export_dir> with memory mapped reads
+def open_export(export_dir):
+    import pyarrow.fs
+    import pyarrow.dataset as ds
+    return ds.dataset(export_dir, schema=get_export_schema(), format="parquet", partitioning=get_export_partitioning(),
+                      filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+
+# Reads the export of <export_dir> back into df_all_stats, restricted to the
+# <db_names> partitions. The file count columns are only kept when the
+# export came from a --deep-scan run
+def load_stats(export_dir, db_names):
+    import pandas as pd
+    import pyarrow.dataset as ds
+    table = open_export(export_dir).to_table(filter=ds.field('db_name').isin(list(db_names)))
+    dataframe = table.to_pandas().rename(columns=dict([(name, column) for column, name in EXPORT_COLUMNS] + [('db_name', 'DB Name')]))
+    for column in ['DB Name', 'Owner', 'InputFormat']:
+        dataframe[column] = pd.Categorical(dataframe[column])
+    file_columns = [column for column, name in EXPORT_COLUMNS[6:]]
+    if dataframe['Files'].isna().all():
+        dataframe = dataframe.drop(columns=file_columns)
+    else:
+        dataframe[file_columns] = dataframe[file_columns].fillna(0)
+        dataframe[file_columns[:3]] = dataframe[file_columns[:3]].astype('int64')
+    dataframe = dataframe[['DB Name', 'Table Name', 'Owner', 'Location', 'totalSize', 'InputFormat', 'totalBytes'] + [
+        column for column in file_columns if column in dataframe.columns]]
+    dataframe.index = dataframe['DB Name'].astype('object') + "." + dataframe['Table Name']
     return dataframe
 
-def generate_mail(db_json, db_names_hdfs, df_all_stats, df_db_name_dict_seg_stats, admin):
-    html_dump = ""
+# Returns a <DataFrame> of the <top> largest tables of the export matching
+# the filters, or with <group_by> (one of EXPORT_GROUP_KEYS) the <top> largest
+# groups with their table count and size. The filters are pushed down to the
+# scan: <db_names> prunes partitions, <min_bytes> skips row groups. Location
+# prefixes keep <prefix_depth> directories of the path
+def query_stats(export_dir, db_names=None, owner=None, input_format=None, location_prefix=None, min_bytes=None,
+                group_by=None, top=20, prefix_depth=3):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    if group_by is not None and group_by not in EXPORT_GROUP_KEYS:
+        raise Exception("Cannot group the export by {0}, use one of {1}".format(group_by, ", ".join(EXPORT_GROUP_KEYS)))
+    filters = []
+    if db_names:
+        filters.append(ds.field('db_name').isin(list(db_names)))
+    if owner is not None:
+        filters.append(ds.field('owner') == owner)
+    if input_format is not None:
+        filters.append(ds.field('input_format') == input_format)
+    if location_prefix is not None:
+        filters.append(pc.starts_with(ds.field('location'), pattern=location_prefix))
+    if min_bytes is not None:
+        filters.append(ds.field('total_bytes') >= min_bytes)
+    condition = None
+    for expression in filters:
+        condition = expression if condition is None else condition & expression
+    dataset = open_export(export_dir)
+    if group_by is None:
+        # Finds the size of the <top>th table from the size column alone, then
+        # reads the other columns of the row groups reaching that size only
+        sizes = dataset.to_table(columns=['total_bytes'], filter=condition)['total_bytes']
+        if len(sizes) > top:
+            threshold = ds.field('total_bytes') >= pc.min(sizes.take(pc.select_k_unstable(sizes, k=top, sort_keys=[('total_bytes', 'descending')])))
+            condition = threshold if condition is None else condition & threshold
+        columns = ['db_name', 'table_name', 'owner', 'input_format', 'location', 'total_bytes', 'total_size_gb']
+        table = dataset.to_table(columns=columns, filter=condition).sort_by([('total_bytes', 'descending')])
+        return table.slice(0, top).to_pandas()
+    columns = ['location' if group_by == 'location_prefix' else group_by, 'total_bytes']
+    table = dataset.to_table(columns=columns, filter=condition)
+    if group_by == 'location_prefix':
+        table = pa.table({'location_prefix' : get_location_prefixes(table['location'], prefix_depth), 'total_bytes' : table['total_bytes']})
+    groups = table.group_by(group_by).aggregate([('total_bytes', 'sum'), ('total_bytes', 'count')])
+    groups = groups.rename_columns([name.replace('total_bytes_count', 'tables').replace('total_bytes_sum', 'total_bytes') for name in groups.column_names])
+    result = groups.sort_by([('total_bytes', 'descending')]).slice(0, top).to_pandas()
+    result['total_size_gb'] = result['total_bytes'] / float(1<<30)
+    return result[[group_by, 'tables', 'total_bytes', 'total_size_gb']]
+
+TEXT_INPUT_FORMATS = ["org.apache.hadoop.mapred.TextInputFormat"]
+# Settings of the "chargeback" config section. Text tables whose name
+# contains "text_exclude" are left out of the conversion savings, as in the
+# text format section of the report
+CHARGEBACK_DEFAULTS = {"replication_factor" : 3, "cost_per_tb" : 0.0, "currency" : "USD",
+                       "text_compression_ratio" : 3.0, "text_exclude" : "ref", "prefix_depth" : 3}
+ROLLUP_KEYS = ['Owner', 'DB Name', 'InputFormat', 'Location Prefix']
+
+# Returns the <ndarray> mask of the Text tables of <dataframe> whose name does
+# not contain <text_exclude>
+def get_text_table_mask(dataframe, text_exclude):
+    text = dataframe['InputFormat'].isin(TEXT_INPUT_FORMATS).values
+    if text_exclude:
+        text = text & ~dataframe['Table Name'].str.contains(text_exclude, regex=False).values
+    return text
+
+def get_chargeback_conf(db_json):
+    conf = dict(CHARGEBACK_DEFAULTS)
+    conf.update(db_json.get("chargeback", {}))
+    return conf
+
+# Returns the <DataFrame> of table count, bytes and text bytes per (Owner,
+# DB Name, InputFormat, Location Prefix), from a single groupby pass over
+# df_all_stats. The coarser rollups are sums of this much smaller frame
+def get_rollup(dataframe, conf):
+    import numpy
+    import pandas as pd
+    import pyarrow as pa
+    total_bytes = dataframe['totalBytes'].values
+    text = get_text_table_mask(dataframe, conf["text_exclude"])
+    prefixes = get_location_prefixes(pa.array(dataframe['Location'].values, pa.string()), conf["prefix_depth"])
+    frame = pd.DataFrame({
+        'Owner' : dataframe['Owner'].values,
+        'DB Name' : dataframe['DB Name'].values,
+        'InputFormat' : dataframe['InputFormat'].values,
+        'Location Prefix' : pd.Categorical(prefixes.to_numpy(zero_copy_only=False)),
+        'Bytes' : total_bytes,
+        'Text Bytes' : numpy.where(text, total_bytes, 0)
+    })
+    grouped = frame.groupby(ROLLUP_KEYS, observed=True, sort=False)
+    rollup = grouped[['Bytes', 'Text Bytes']].sum()
+    rollup.insert(0, 'Tables', grouped.size())
+    return rollup
+
+# Returns <rollup> summed by <keys>, with its storage cost: the bytes times
+# the replication factor at the cost per TB, and the savings of converting
+# its text tables to Parquet/ORC at the text compression ratio
+def get_chargeback(rollup, keys, conf):
+    chargeback = rollup.groupby(keys, observed=True)[['Tables', 'Bytes', 'Text Bytes']].sum() if keys else rollup.copy()
+    replication, cost_per_tb = float(conf["replication_factor"]), float(conf["cost_per_tb"])
+    chargeback['Raw TB'] = chargeback['Bytes'] / float(1<<40)
+    chargeback['Replicated TB'] = chargeback['Raw TB'] * replication
+    chargeback['Cost'] = chargeback['Replicated TB'] * cost_per_tb
+    chargeback['Text TB'] = chargeback['Text Bytes'] / float(1<<40)
+    chargeback['Conversion Savings TB'] = chargeback['Text TB'] * (1 - 1 / float(conf["text_compression_ratio"])) * replication
+    chargeback['Conversion Savings'] = chargeback['Conversion Savings TB'] * cost_per_tb
+    return chargeback.sort_values('Bytes', ascending=False)
+
+# Writes the chargeback at the finest grain of <rollup> to <file_path>
+def write_chargeback_csv(rollup, conf, file_path):
+    get_chargeback(rollup, None, conf).reset_index().to_csv(file_path, index=False, float_format='%.6f')
+
+# Queues the franchise mails (or the admin mail) into <outbox_dir>, see deliver_outbox
+# <admin_body_extra> is html added to the body of the admin mail
+def generate_mail(db_json, db_names_hdfs, report_model, admin, outbox_dir, admin_body_extra=""):
+    html_dump = []
     for db in db_names_hdfs:
-        # Function fingerprint: franchise_name, send_from, send_to, subject, email_content, files, server_host, server_port
+        # Function fingerprint: outbox_dir, franchise_name, send_from, send_to, subject, email_content, files
         if admin == False:
-            html_dump = get_html(df_all_stats, df_db_name_dict_seg_stats[db], db_json[db]["name"])
-            send_mail(db_json[db]["name"], db_json["admin"]["email"], db_json[db]["email"], db_json["mail_format"]["subject"], db_json["mail_format"]["body"], html_dump, db_json["admin"]["server_host"], db_json["admin"]["server_port"])
+            html_dump = [report_model[db]]
+            queue_mail(outbox_dir, db_json[db]["name"], db_json["admin"]["email"], db_json[db]["email"], db_json["mail_format"]["subject"], db_json["mail_format"]["body"], html_dump)
         if admin == True:
-            html_dump = html_dump + get_html(df_all_stats, df_db_name_dict_seg_stats[db], db_json[db]["name"])
+            html_dump.append(report_model[db])
     if admin == True:
-        send_mail("HDFS Report", db_json["admin"]["email"], db_json["admin"]["all_stats_to_email"], db_json["mail_format"]["subject"], db_json["mail_format"]["body"], html_dump, db_json["admin"]["server_host"], db_json["admin"]["server_port"])
+        body = db_json["mail_format"]["body"]
+        if admin_body_extra:
+            body = body.replace("</body>", admin_body_extra + "</body>") if "</body>" in body else body + admin_body_extra
+        queue_mail(outbox_dir, "HDFS Report", db_json["admin"]["email"], db_json["admin"]["all_stats_to_email"], db_json["mail_format"]["subject"], body, html_dump)
 
-if __name__ == '__main__':
+# Delivers the outbox and reports the mails which could not be sent. A
+# temporary outbox is removed once it is empty
+def send_outbox(outbox_dir, admin_conf, workers, retries, keep_outbox):
+    failed = deliver_outbox(outbox_dir, admin_conf, workers, retries)
+    if failed:
+        for mail_id, error in failed.items():
+            print("Mail {0} was not delivered: {1}".format(mail_id, error))
+        raise Exception("{0} mails left undelivered, replay them with --outbox {1} --replay-outbox".format(len(failed), outbox_dir))
+    if not keep_outbox:
+        shutil.rmtree(outbox_dir, ignore_errors=True)
 
-    file_name = main()
-    css_file = args.cssfile
+#Reads the JSON config, returns (<config dict>, <database names list>)
+def read_config(file_name):
+    db_json = read_from_json(file_name)
+    db_names_hdfs = convert_json_to_list(db_json, "key")
+    for section in CONFIG_SECTIONS:
+        if section in db_names_hdfs:
+            db_names_hdfs.remove(section)
+    return db_json, db_names_hdfs
 
-    try:
-        spark = SparkSession.builder.enableHiveSupport().appName("HDFS Stats Generator").getOrCreate()
-        print(spark.version)
-        log=spark.sparkContext._jvm.org.apache.log4j.LogManager.getLogger(__name__)
-
-        stats, out_dict = {}, {}
-        with open(css_file, 'r') as myfile:
-            style = myfile.read()
-
-        db_names_file_path_to_json = file_name
-
-        db_names_hdfs = convert_json_to_list(read_from_json(db_names_file_path_to_json), "key")
-        db_json = read_from_json(db_names_file_path_to_json)
-
-        db_names_hdfs.remove("admin")
-        db_names_hdfs.remove("mail_format")
-
-        print("Databases Used:")
-        print("\n".join(db_names_hdfs))
-
-        # Function populates the stat<dict> with all the info obtained from the
-        # db_names_hdfs<list> database names
-        print("Collecting all stats...")
-        collect_all_stats(db_names_hdfs, spark)
-
-        print("Creating the Dataframe...")
-        # Creates a df_all_stats<DataFrame> with all the stats in the databases specified
-        print("Creating DL_ALL_STATS <dict>")
-        df_all_stats = pd.DataFrame.from_dict(out_dict, orient='index', columns=['DB Name', 'Table Name', 'Owner', 'Location', 'totalSize', 'InputFormat'])
-        df_all_stats.rename_axis('Table Name')
-        # Converts the column 'totalSize' to numeric
-        df_all_stats = convert_clm_to_numeric(df_all_stats)
-        # Converts the NaN values to to ZERO
-        df_all_stats = get_convert_nan_to_zero(df_all_stats)
-        # Converts the sizes from KB to GB
-        df_all_stats = convert_kb_to_gb(df_all_stats, "totalSize")
-        print("DL_ALL_STATS: " + str(df_all_stats.head(1)))
-        print("Segregating dataframe database wise..")
-        # Segregates the df_all_stats<DataFrame> into database wise <DataFrame> in df_db_name_dict_seg_stats<dict>
+# Returns the <list> of the problems found in the JSON config <db_json>
+def validate_config(db_json):
+    problems = []
+    required = {"admin" : ["email", "all_stats_to_email", "server_host", "server_port"], "mail_format" : ["subject", "body"]}
+    for section, keys in required.items():
+        if not isinstance(db_json.get(section), dict):
+            problems.append("missing section " + section)
+            continue
+        problems.extend("missing {0}.{1}".format(section, key) for key in keys if key not in db_json[section])
+    if "metastore" in db_json:
+        problems.extend("missing metastore." + key for key in ["driver", "connect"] if key not in db_json["metastore"])
+        if "driver" in db_json["metastore"]:
+            try:
+                get_metastore_dialect(db_json["metastore"])
+            except Exception as e:
+                problems.append(str(e))
+    if "chargeback" in db_json:
+        for key, value in db_json["chargeback"].items():
+            if key not in CHARGEBACK_DEFAULTS:
+                problems.append("unknown key chargeback." + key)
+            elif key not in ("currency", "text_exclude") and not isinstance(value, (int, float)):
+                problems.append("chargeback.{0} is not a number".format(key))
+    db_names_hdfs = [name for name in db_json if name not in CONFIG_SECTIONS]
+    if not db_names_hdfs:
+        problems.append("no database configured")
+    for db in db_names_hdfs:
+        if not isinstance(db_json[db], dict):
+            problems.append("database {0} is not an object".format(db))
+            continue
+        problems.extend("missing {0}.{1}".format(db, key) for key in ["name", "email"] if key not in db_json[db])
+    return problems
+
+# Creates the SparkSession, only the collection needs one
+def get_spark_session():
+    from pyspark.sql import SparkSession
+    spark = SparkSession.builder.enableHiveSupport().appName("HDFS Stats Generator").getOrCreate()
+    print(spark.version)
+    return spark
+
+# Collects the stats of <db_names_hdfs> and returns (df_all_stats, <dict> of
+# the tables and databases which could not be collected)
+def collect_stats(args, db_json, db_names_hdfs):
+    stats, out_dict, collect_errors = {}, {}, {}
+    # The metastore backend only needs Spark for the filesystem scans
+    spark = None
+    if args.backend == 'describe' or args.size_source == 'filesystem' or args.deep_scan:
+        spark = get_spark_session()
+
+    print("Databases Used:")
+    print("\n".join(db_names_hdfs))
+
+    # Function populates the stat<dict> with all the info obtained from the
+    # db_names_hdfs<list> database names
+    print("Collecting all stats...")
+    with timed("collect"):
+        if args.backend == 'metastore':
+            out_dict = collect_all_stats_from_metastore(db_names_hdfs, db_json["metastore"])
+        else:
+            snapshot_conn = open_snapshot_store(args.snapshot) if args.snapshot else None
+            stats = collect_all_stats(db_names_hdfs, spark, args.workers, args.db_concurrency, snapshot_conn, args.fingerprint_mtime,
+                                      analyze=args.size_source == 'metastore', errors=collect_errors, retries=args.table_retries,
+                                      checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every,
+                                      run_id=args.run_id, checkpoint_max_hours=args.checkpoint_max_hours)
+            for db_name in db_names_hdfs:
+                collect_db_stat(db_name, stats, out_dict)
+    if args.deep_scan:
+        # The deep scan walks every location, so with the filesystem size
+        # source the table sizes are taken from it instead of a second pass
+        print("Deep scanning the table locations on the executors...")
+        with timed("deep scan"):
+            partition_stats = collect_partition_stats(out_dict, spark, args.small_file_mb << 20, args.size_partitions,
+                                                      update_sizes=args.size_source == 'filesystem', errors=collect_errors)
+        if args.partition_stats_csv:
+            partition_stats.to_csv(args.partition_stats_csv, index=False)
+    elif args.size_source == 'filesystem':
+        print("Sizing the table locations on the executors...")
+        with timed("size locations"):
+            collect_location_sizes(out_dict, spark, args.size_partitions, collect_errors)
+
+    print("Creating the Dataframe...")
+    # Creates a df_all_stats<DataFrame> with all the stats in the databases specified
+    print("Creating DL_ALL_STATS <dict>")
+    # Types the columns and converts the sizes from bytes to GB in one pass
+    with timed("build dataframe"):
+        df_all_stats = build_stats_frame(list(out_dict.values()))
+    if args.deep_scan:
+        df_all_stats = df_all_stats.join(get_table_file_stats(partition_stats))
+        count_columns = ['Partitions', 'Files', 'Small Files']
+        df_all_stats[count_columns] = df_all_stats[count_columns].fillna(0).astype('int64')
+        df_all_stats[['Avg File Size (MB)', 'Small File Ratio']] = df_all_stats[['Avg File Size (MB)', 'Small File Ratio']].fillna(0)
+    print("DL_ALL_STATS: " + str(df_all_stats.head(1)))
+    if args.history:
+        print("Appending the stats to the history store...")
+        with timed("history"):
+            append_history(df_all_stats, args.history, datetime.date.today().isoformat())
+    return df_all_stats, collect_errors
+
+# Saves df_all_stats to the export, with the collection errors in
+# <export_dir>/_errors.json (skipped by the Parquet readers)
+def save_stats(df_all_stats, collect_errors, export_dir):
+    print("Exporting the stats to " + str(export_dir))
+    with timed("export"):
+        export_stats(df_all_stats, export_dir)
+        with open(os.path.join(export_dir, "_errors.json"), 'w') as errors_file:
+            json.dump(collect_errors, errors_file)
+
+def load_collect_errors(export_dir):
+    errors_path = os.path.join(export_dir, "_errors.json")
+    if not os.path.exists(errors_path):
+        return {}
+    with open(errors_path) as errors_file:
+        return json.load(errors_file)
+
+# Renders the reports of df_all_stats and queues the franchise mails and the
+# admin mail into <outbox_dir>
+def render_reports(args, db_json, db_names_hdfs, df_all_stats, collect_errors, outbox_dir):
+    global style
+    with open(args.cssfile, 'r') as myfile:
+        style = myfile.read()
+    print("Segregating dataframe database wise..")
+    # Segregates the df_all_stats<DataFrame> into database wise <DataFrame> in df_db_name_dict_seg_stats<dict>
+    with timed("segregate dataframe"):
         df_db_name_dict_seg_stats = segregate_df_on_db(db_names_hdfs, df_all_stats)
-        print("Sending mail to Franchise Leads...")
-        #Send mail to the franchise leads
-        generate_mail(db_json, db_names_hdfs, df_all_stats, df_db_name_dict_seg_stats, admin=False)
-        print("Sending mail to Admin Leads...")
-        #Send mail to the Admin
-        generate_mail(db_json, db_names_hdfs, df_all_stats, df_db_name_dict_seg_stats, admin=True)
+    growth_html = {}
+    if args.history:
+        with timed("history"):
+            growth_html = get_growth_html(db_json, db_names_hdfs, args.history)
+    rollup = None
+    # The chargeback sections come with a "chargeback" config section
+    if "chargeback" in db_json or args.chargeback_csv:
+        print("Rolling up the storage costs...")
+        with timed("rollup"):
+            rollup = get_rollup(df_all_stats, get_chargeback_conf(db_json))
+        if args.chargeback_csv:
+            write_chargeback_csv(rollup, get_chargeback_conf(db_json), args.chargeback_csv)
+        if "chargeback" not in db_json:
+            rollup = None
+    print("Rendering the reports...")
+    with timed("render reports"):
+        report_model = build_report_model(db_json, db_names_hdfs, df_all_stats, df_db_name_dict_seg_stats, growth_html, args.chart_workers, args.chart_format,
+                                          rollup)
+    print("Queuing mail to Franchise Leads...")
+    #Queue mail to the franchise leads
+    with timed("queue mail"):
+        generate_mail(db_json, db_names_hdfs, report_model, admin=False, outbox_dir=outbox_dir)
+    # The profile in the admin mail covers the run up to this point
+    admin_body_extra = get_html_profile(get_profile_summary()) if args.profile_mail else ""
+    if rollup is not None:
+        chargeback_conf = get_chargeback_conf(db_json)
+        admin_body_extra = admin_body_extra + get_html_chargeback("Chargeback per Owner", get_chargeback(rollup, 'Owner', chargeback_conf), chargeback_conf)
+        admin_body_extra = admin_body_extra + get_html_chargeback("Chargeback per InputFormat", get_chargeback(rollup, 'InputFormat', chargeback_conf), chargeback_conf)
+    if collect_errors:
+        admin_body_extra = admin_body_extra + get_html_errors(collect_errors)
+    print("Queuing mail to Admin Leads...")
+    #Queue mail to the Admin
+    with timed("queue mail"):
+        generate_mail(db_json, db_names_hdfs, report_model, admin=True, outbox_dir=outbox_dir, admin_body_extra=admin_body_extra)
+
+# Prints the slowest tables and databases of the run and writes --profile
+def report_profile(args):
+    if run_profile is None:
+        return
+    summary = get_profile_summary()
+    print("Slowest tables:")
+    print("\n".join("{0}: {1:.2f}s".format(key, secs) for key, secs in summary["slowest_tables"][:5]))
+    print("Slowest databases:")
+    print("\n".join("{0}: {1:.2f}s".format(key, secs) for key, secs in summary["slowest_databases"][:5]))
+    if args.profile:
+        write_profile(args.profile, summary)
 
+# The run is complete, the next one starts from scratch
+def remove_checkpoint(args):
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+def command_run(args):
+    db_json, db_names_hdfs = read_config(args.jsonconfig)
+    if args.replay_outbox:
+        if args.outbox is None:
+            raise Exception("--replay-outbox needs the --outbox directory to replay")
+        print("Replaying the outbox " + str(args.outbox))
+        send_outbox(args.outbox, db_json["admin"], args.smtp_workers, args.smtp_retries, keep_outbox=True)
         print("Emailed all the reports")
+        return
+    df_all_stats, collect_errors = collect_stats(args, db_json, db_names_hdfs)
+    if args.export:
+        save_stats(df_all_stats, collect_errors, args.export)
+    outbox_dir = args.outbox or tempfile.mkdtemp(prefix="hdfs_stats_outbox_")
+    render_reports(args, db_json, db_names_hdfs, df_all_stats, collect_errors, outbox_dir)
+    print("Sending the queued mails...")
+    with timed("send mail"):
+        send_outbox(outbox_dir, db_json["admin"], args.smtp_workers, args.smtp_retries, keep_outbox=args.outbox is not None)
+    report_profile(args)
+    remove_checkpoint(args)
+    print("Emailed all the reports")
+
+def command_collect(args):
+    db_json, db_names_hdfs = read_config(args.jsonconfig)
+    df_all_stats, collect_errors = collect_stats(args, db_json, db_names_hdfs)
+    save_stats(df_all_stats, collect_errors, args.export)
+    report_profile(args)
+    remove_checkpoint(args)
+    print("Collected {0} tables into {1}".format(len(df_all_stats), args.export))
+
+def command_render(args):
+    db_json, db_names_hdfs = read_config(args.jsonconfig)
+    with timed("load export"):
+        df_all_stats = load_stats(args.export, db_names_hdfs)
+    render_reports(args, db_json, db_names_hdfs, df_all_stats, load_collect_errors(args.export), args.outbox)
+    report_profile(args)
+    print("Queued the reports into " + str(args.outbox))
+
+def command_send(args):
+    db_json, db_names_hdfs = read_config(args.jsonconfig)
+    print("Sending the outbox " + str(args.outbox))
+    with timed("send mail"):
+        send_outbox(args.outbox, db_json["admin"], args.smtp_workers, args.smtp_retries, keep_outbox=True)
+    report_profile(args)
+    print("Emailed all the reports")
+
+def command_validate_config(args):
+    problems = validate_config(read_from_json(args.jsonconfig))
+    if args.cssfile is not None and not os.path.isfile(args.cssfile):
+        problems.append("cannot read the css file " + args.cssfile)
+    if problems:
+        raise Exception("Invalid config {0}: {1}".format(args.jsonconfig, "; ".join(problems)))
+    print("Config {0} is valid: {1} databases".format(args.jsonconfig, len(read_config(args.jsonconfig)[1])))
+
+def command_query(args):
+    min_bytes = None if args.min_gb is None else int(args.min_gb * (1<<30))
+    result = query_stats(args.export, args.db, args.owner, args.format, args.location, min_bytes, args.group_by, args.top, args.prefix_depth)
+    print(result.to_string(index=False))
 
+COMMAND_FUNCTIONS = {"run" : command_run, "collect" : command_collect, "render" : command_render, "send" : command_send,
+                     "validate-config" : command_validate_config, "query" : command_query}
+
+def main(argv=None):
+    module_name = os.path.basename(sys.argv[0])
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if getattr(args, 'jsonconfig', None) is not None:
+        print("value of run_args for module {0} is: ".format(module_name) + args.jsonconfig)
+    if getattr(args, 'profile', None) or getattr(args, 'profile_mail', False):
+        enable_profiling()
+    try:
+        COMMAND_FUNCTIONS[args.command](args)
     except Exception as e:
         msg = "Module execution interrupted, following error occured : " + str(e)
         raise Exception(msg)
+
+if __name__ == '__main__':
+    main()
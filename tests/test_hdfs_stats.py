@@ -0,0 +1,163 @@
+# coding: utf-8
+
+# ------------------------------------------------------------------------
+# Module Name :- hdfs_stats tests
+# Module description : - Tests of the parts of hdfs_stats which need no Spark: the checkpoint,
+#                        the metastore backend, the mail writer and the report helpers
+# ----------------------
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hdfs_stats
+
+def test_deep_scan_locations_yields_an_error_row_per_unreadable_location(tmp_path):
+    pytest.importorskip("pyarrow")
+    tmp_path.joinpath("tbl", "dt=1").mkdir(parents=True)
+    tmp_path.joinpath("tbl", "dt=1", "part-0").write_bytes(b"x" * 10)
+    tmp_path.joinpath("empty").mkdir()
+    rows = list(hdfs_stats.deep_scan_locations([str(tmp_path / "tbl"), str(tmp_path / "empty"), "nosuchfs://nn/tbl"], 100))
+    assert rows[0] == (str(tmp_path / "tbl"), "dt=1", 1, 10, 1, None)
+    assert rows[1] == (str(tmp_path / "empty"), None, 0, 0, 0, None)
+    assert rows[2][:5] == ("nosuchfs://nn/tbl", None, 0, 0, 0) and rows[2][5]
+
+def test_mail_message_has_no_bare_line_feed():
+    import email
+    import re
+    subject = "HDFS Stats Report of the Data Lake databases for the franchise leads, with the growth and the chargeback, é"
+    assert len(subject) > 100
+    out = []
+    hdfs_stats.write_mail_message(out.append, "DB Name 1", "from@abc.com", "to@abc.com", subject, "<p>report</p>", "<html>" + "x" * 5000 + "</html>")
+    message = b"".join(out)
+    assert re.search(b"(?<!\r)\n", message) is None
+    parsed = email.message_from_bytes(message)
+    assert str(email.header.make_header(email.header.decode_header(parsed["Subject"]))) == subject
+
+def test_load_checkpoint_cuts_a_torn_last_line(tmp_path):
+    checkpoint = str(tmp_path / "checkpoint.jsonl")
+    hdfs_stats.start_checkpoint(checkpoint, None, ["db"])
+    hdfs_stats.append_checkpoint(checkpoint, [("db", "t1", {"totalSize" : "1"})])
+    with open(checkpoint, 'a') as checkpoint_file:
+        checkpoint_file.write('{"db": "db", "tbl": "t2", "st')
+    assert hdfs_stats.load_checkpoint(checkpoint, None, ["db"]) == {"db" : {"t1" : {"totalSize" : "1"}}}
+    # The entries of the resumed run start on a line of their own
+    hdfs_stats.append_checkpoint(checkpoint, [("db", "t2", None), ("db", "t3", {"totalSize" : "3"})])
+    assert hdfs_stats.load_checkpoint(checkpoint, None, ["db"]) == {"db" : {"t1" : {"totalSize" : "1"}, "t2" : None, "t3" : {"totalSize" : "3"}}}
+
+@pytest.mark.parametrize("run_id, db_names", [("other", ["db"]), (None, ["db", "db2"]), ("run-1", ["db"])])
+def test_load_checkpoint_ignores_the_checkpoint_of_another_run(tmp_path, run_id, db_names):
+    checkpoint = str(tmp_path / "checkpoint.jsonl")
+    hdfs_stats.start_checkpoint(checkpoint, "run-1" if run_id is None else None, ["db"])
+    hdfs_stats.append_checkpoint(checkpoint, [("db", "t1", None)])
+    assert hdfs_stats.load_checkpoint(checkpoint, run_id, db_names) == {}
+    assert not os.path.exists(checkpoint)
+
+def test_load_checkpoint_resumes_a_recent_run_without_run_id(tmp_path):
+    import datetime
+    import json
+    checkpoint = str(tmp_path / "checkpoint.jsonl")
+    started = datetime.datetime.now() - datetime.timedelta(hours=3)
+    with open(checkpoint, 'w') as checkpoint_file:
+        checkpoint_file.write(json.dumps({"run" : None, "started" : started.isoformat(), "databases" : ["db"]}) + "\n")
+    hdfs_stats.append_checkpoint(checkpoint, [("db", "t1", None)])
+    assert hdfs_stats.load_checkpoint(checkpoint, None, ["db"]) == {"db" : {"t1" : None}}
+    # Too old to be the same run without a run id
+    assert hdfs_stats.load_checkpoint(checkpoint, None, ["db"], max_hours=2) == {}
+
+def test_load_checkpoint_ignores_a_checkpoint_without_header(tmp_path):
+    checkpoint = str(tmp_path / "checkpoint.jsonl")
+    hdfs_stats.append_checkpoint(checkpoint, [("db", "t1", None)])
+    assert hdfs_stats.load_checkpoint(checkpoint, None, ["db"]) == {}
+
+def test_snapshot_keeps_the_tables_which_failed_to_collect(tmp_path, monkeypatch):
+    failing = set()
+    def collect_tbl_stats(db_name, tbl_name, spark, cached, location_mtime, analyze):
+        if tbl_name in failing:
+            raise RuntimeError("boom")
+        return {'Owner' : 'owner', 'Location' : '/db/' + tbl_name, 'totalSize' : '10', 'InputFormat' : 'text', 'fingerprint' : tbl_name}
+    monkeypatch.setattr(hdfs_stats, "find_db_tbl_name", lambda db_name, spark: ["db.t1", "db.t2"])
+    monkeypatch.setattr(hdfs_stats, "collect_tbl_stats", collect_tbl_stats)
+    conn = hdfs_stats.open_snapshot_store(str(tmp_path / "snapshot.db"))
+    hdfs_stats.collect_all_stats(["db"], None, workers=2, snapshot_conn=conn)
+    failing.add("t2")
+    errors = {}
+    stats = hdfs_stats.collect_all_stats(["db"], None, workers=2, snapshot_conn=conn, errors=errors)
+    assert list(stats["db"]) == ["t1"] and list(errors) == ["db.t2"]
+    assert sorted(hdfs_stats.load_db_snapshot(conn, "db")) == ["t1", "t2"]
+
+# SQLite stand-in of the Hive metastore tables read by the metastore backend
+METASTORE_SCRIPT = """
+CREATE TABLE DBS (DB_ID INTEGER, NAME TEXT);
+CREATE TABLE TBLS (TBL_ID INTEGER, DB_ID INTEGER, SD_ID INTEGER, TBL_NAME TEXT, TBL_TYPE TEXT, OWNER TEXT);
+CREATE TABLE SDS (SD_ID INTEGER, LOCATION TEXT, INPUT_FORMAT TEXT);
+CREATE TABLE TABLE_PARAMS (TBL_ID INTEGER, PARAM_KEY TEXT, PARAM_VALUE TEXT);
+CREATE TABLE PARTITIONS (PART_ID INTEGER, TBL_ID INTEGER);
+CREATE TABLE PARTITION_PARAMS (PART_ID INTEGER, PARAM_KEY TEXT, PARAM_VALUE TEXT);
+INSERT INTO DBS VALUES (1, 'db1'), (2, 'db2');
+INSERT INTO TBLS VALUES (1, 1, 1, 'flat', 'MANAGED_TABLE', 'o1'), (2, 1, 2, 'partitioned', 'EXTERNAL_TABLE', 'o2'),
+                        (3, 1, 3, 'view', 'VIRTUAL_VIEW', 'o2'), (4, 1, 4, 'mview', 'MATERIALIZED_VIEW', 'o2'),
+                        (5, 1, 5, 'unsized', 'MANAGED_TABLE', 'o1'), (6, 2, 6, 'other', 'MANAGED_TABLE', 'o3');
+INSERT INTO SDS VALUES (1, 'hdfs://nn/db1/flat', 'TextInputFormat'), (2, 'hdfs://nn/db1/partitioned', 'ParquetInputFormat'),
+                       (3, NULL, NULL), (4, 'hdfs://nn/db1/mview', 'OrcInputFormat'),
+                       (5, 'hdfs://nn/db1/unsized', 'OrcInputFormat'), (6, 'hdfs://nn/db2/other', 'OrcInputFormat');
+INSERT INTO TABLE_PARAMS VALUES (1, 'totalSize', '100'), (1, 'numFiles', '3'), (6, 'totalSize', '5');
+INSERT INTO PARTITIONS VALUES (1, 2), (2, 2);
+INSERT INTO PARTITION_PARAMS VALUES (1, 'totalSize', '7'), (2, 'totalSize', '8'), (2, 'numFiles', '1');
+"""
+
+@pytest.mark.parametrize("dialect", ["mysql", "postgresql"])
+def test_collect_all_stats_from_metastore(tmp_path, dialect):
+    import sqlite3
+    database = str(tmp_path / "metastore.db")
+    with sqlite3.connect(database) as conn:
+        conn.executescript(METASTORE_SCRIPT)
+    out_dict = hdfs_stats.collect_all_stats_from_metastore(["db1", "missing"], {"driver" : "sqlite3", "dialect" : dialect, "connect" : {"database" : database}})
+    # Views are left out and partitioned tables are sized from their partitions
+    assert out_dict == {
+        "db1.flat" : ["db1", "flat", "o1", "hdfs://nn/db1/flat", 100, "TextInputFormat"],
+        "db1.partitioned" : ["db1", "partitioned", "o2", "hdfs://nn/db1/partitioned", 15, "ParquetInputFormat"],
+        "db1.unsized" : ["db1", "unsized", "o1", "hdfs://nn/db1/unsized", 0, "OrcInputFormat"]
+    }
+
+def test_get_metastore_dialect():
+    assert hdfs_stats.get_metastore_dialect({"driver" : "pymysql"}) == "mysql"
+    assert hdfs_stats.get_metastore_dialect({"driver" : "psycopg2"}) == "postgresql"
+    assert hdfs_stats.get_metastore_dialect({"driver" : "sqlite3", "dialect" : "postgresql"}) == "postgresql"
+    with pytest.raises(Exception):
+        hdfs_stats.get_metastore_dialect({"driver" : "cx_Oracle", "dialect" : "oracle"})
+
+@pytest.mark.parametrize("locations, common", [
+    (["hdfs://nn1/warehouse/db.db/a", "hdfs://nn1/warehouse/db.db/b/"], "hdfs://nn1/warehouse/db.db"),
+    (["hdfs://nn1/warehouse/a", "hdfs://nn1/warehouse/ab"], "hdfs://nn1/warehouse"),
+    (["hdfs://nn1/a", "hdfs://nn1/b"], "hdfs://nn1"),
+    (["hdfs://nn1/a", "hdfs://nn2/a"], ""),
+    (["hdfs://nn1/a", "s3a://nn1/a"], ""),
+    (["/data/db/a", "/data/db/b"], "/data/db"),
+    (["hdfs://nn1/a", None], "hdfs://nn1/a"),
+    ([None], "")])
+def test_get_common_location(locations, common):
+    pd = pytest.importorskip("pandas")
+    assert hdfs_stats.get_common_location(pd.DataFrame({'Location' : locations})) == common
+
+def test_text_format_card_and_conversion_savings_exclude_the_same_tables():
+    pd = pytest.importorskip("pandas")
+    text = "org.apache.hadoop.mapred.TextInputFormat"
+    dataframe = pd.DataFrame({
+        'DB Name' : ["db"] * 4,
+        'Table Name' : ["ref_codes", "stg.orders", "stgxorders", "parquet_tbl"],
+        'Owner' : ["o1", "o1", "o2", "o2"],
+        'Location' : ["hdfs://nn/db/" + str(index) for index in range(4)],
+        'InputFormat' : [text, text, text, "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat"],
+        'totalSize' : [1.0, 2.0, 3.0, 4.0],
+        'totalBytes' : [1 << 30, 2 << 30, 3 << 30, 4 << 30]
+    }).set_index('Table Name', drop=False)
+    # The exclusion is a plain substring, "." is not a regex wildcard
+    conf = dict(hdfs_stats.CHARGEBACK_DEFAULTS, text_exclude="stg.")
+    card = hdfs_stats.get_text_formatted_tables(dataframe, conf["text_exclude"])
+    assert "hdfs://nn/db/0" in card and "hdfs://nn/db/2" in card
+    assert "hdfs://nn/db/1" not in card and "hdfs://nn/db/3" not in card
+    rollup = hdfs_stats.get_rollup(dataframe, conf)
+    assert rollup['Text Bytes'].sum() == (1 << 30) + (3 << 30)
@@ -0,0 +1,99 @@
+# coding: utf-8
+
+# ------------------------------------------------------------------------
+# Module Name :- Spark local mode tests
+# Module description : - Runs the filesystem sizing and the deep scan of hdfs_stats against a local
+#                        SparkSession and table locations in a temp directory.
+#                        Skipped when pyspark (or its JVM) is not available
+# ----------------------
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("pyspark")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hdfs_stats
+
+@pytest.fixture(scope="module")
+def spark():
+    from pyspark.sql import SparkSession
+    try:
+        session = SparkSession.builder.master("local[2]").appName("hdfs_stats tests").getOrCreate()
+    except Exception as e:
+        pytest.skip("No local SparkSession: " + str(e).split("\n")[0])
+    yield session
+    session.stop()
+
+# Writes {<relative path> : <bytes>} under <root> and returns its location
+def make_location(root, files):
+    for rel_path, size in files.items():
+        path = root.joinpath(rel_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+    return "file://" + str(root)
+
+def test_collect_location_sizes(tmp_path, spark):
+    flat = make_location(tmp_path / "flat", {"part-0" : 100, "part-1" : 250})
+    partitioned = make_location(tmp_path / "partitioned", {"dt=1/part-0" : 10, "dt=2/part-0" : 20, "dt=2/part-1" : 30})
+    out_dict = {
+        "db.flat" : ["db", "flat", "owner", flat, 0, "text"],
+        "db.partitioned" : ["db", "partitioned", "owner", partitioned, 0, "parquet"],
+        "db.missing" : ["db", "missing", "owner", "file://" + str(tmp_path / "missing"), 42, "text"],
+        "db.broken" : ["db", "broken", "owner", "nosuchfs://nn/db/broken", 42, "text"],
+        "db.view" : ["db", "view", "owner", None, 7, None]
+    }
+    errors = {}
+    hdfs_stats.collect_location_sizes(out_dict, spark, num_slices=2, errors=errors)
+    assert out_dict["db.flat"][4] == 350
+    assert out_dict["db.partitioned"][4] == 60
+    assert out_dict["db.missing"][4] == 0
+    # Unreadable locations keep their metastore size and are reported
+    assert out_dict["db.broken"][4] == 42
+    assert list(errors) == ["db.broken"]
+    assert out_dict["db.view"][4] == 7
+
+def test_collect_location_sizes_fails_when_no_location_is_readable(spark):
+    out_dict = {"db.broken" : ["db", "broken", "owner", "nosuchfs://nn/db/broken", 42, "text"]}
+    with pytest.raises(RuntimeError):
+        hdfs_stats.collect_location_sizes(out_dict, spark)
+
+def test_sizing_and_deep_scan_skip_hidden_files(tmp_path, spark):
+    files = {"dt=1/part-0" : 10, "dt=1/_SUCCESS" : 5, "_SUCCESS" : 5, ".hive-staging_1/part-0" : 7, "_temporary/0/part-0" : 9}
+    location = make_location(tmp_path / "tbl", files)
+    sized = {"db.tbl" : ["db", "tbl", "owner", location, 0, "text"]}
+    scanned = {"db.tbl" : ["db", "tbl", "owner", location, 0, "text"]}
+    hdfs_stats.collect_location_sizes(sized, spark)
+    hdfs_stats.collect_partition_stats(scanned, spark, small_file_bytes=100, update_sizes=True)
+    assert sized["db.tbl"][4] == scanned["db.tbl"][4] == 10
+
+def test_deep_scan_sizes_tables(tmp_path, spark):
+    partitioned = make_location(tmp_path / "partitioned", {"dt=1/part-0" : 10, "dt=2/part-0" : 20, "dt=2/part-1" : 300, "_SUCCESS" : 5})
+    empty = tmp_path / "empty"
+    empty.mkdir()
+    out_dict = {
+        "db.partitioned" : ["db", "partitioned", "owner", partitioned, 0, "parquet"],
+        "db.empty" : ["db", "empty", "owner", "file://" + str(empty), 99, "text"]
+    }
+    partition_stats = hdfs_stats.collect_partition_stats(out_dict, spark, small_file_bytes=100, num_slices=2, update_sizes=True)
+    # Hidden files are skipped, as Hive does when it sums the table size
+    assert out_dict["db.partitioned"][4] == 330
+    assert out_dict["db.empty"][4] == 0
+    assert sorted(partition_stats['Partition']) == ["dt=1", "dt=2"]
+    table_stats = hdfs_stats.get_table_file_stats(partition_stats).loc["db.partitioned"]
+    assert (table_stats['Partitions'], table_stats['Files'], table_stats['Small Files']) == (2, 3, 2)
+
+def test_deep_scan_reports_unreadable_locations(tmp_path, spark):
+    location = make_location(tmp_path / "tbl", {"part-0" : 10})
+    out_dict = {
+        "db.tbl" : ["db", "tbl", "owner", location, 0, "text"],
+        "db.broken" : ["db", "broken", "owner", "nosuchfs://nn/db/broken", 42, "text"]
+    }
+    errors = {}
+    partition_stats = hdfs_stats.collect_partition_stats(out_dict, spark, small_file_bytes=100, update_sizes=True, errors=errors)
+    assert list(partition_stats['Table Name']) == ["tbl"]
+    assert out_dict["db.broken"][4] == 42
+    assert list(errors) == ["db.broken"]
+    with pytest.raises(RuntimeError):
+        hdfs_stats.collect_partition_stats({"db.broken" : out_dict["db.broken"]}, spark, small_file_bytes=100)